@@ -1,7 +1,6 @@
-import random
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
 
+import numpy as np
 from rich.cells import cell_len
 from rich.text import Text
 
@@ -9,88 +8,120 @@ BG_STYLE = "dim #FFD700"
 
 
 class Background(ABC):
+    def __init__(self) -> None:
+        self._bg_rows: list[str] | None = None
+        # Per row the background, the content line overlaid on it (if any) and the
+        # composed result, only rows where either input changed are composed again
+        self._rows: list[tuple[str, Text | None, Text]] = []
+        self._frame: Text | None = None
+
     @abstractmethod
     def resize(self, w: int, h: int) -> None: ...
 
     @abstractmethod
-    def get_bg_rows(self, w: int, h: int) -> list[str]: ...
+    def get_bg_rows(self, w: int, h: int) -> list[str]:
+        """Advance the background by one frame and return its rows."""
 
-    def render(self, content_lines: list[Text], w: int, h: int) -> Text:
-        bg_rows = self.get_bg_rows(w, h)
+    def render(
+        self, content_lines: list[Text], w: int, h: int, advance: bool = True
+    ) -> Text:
+        # Reuse the last frame unless we're asked to animate (or the size changed)
+        bg_rows = self._bg_rows
+        if advance or not bg_rows or len(bg_rows) != h or len(bg_rows[0]) != w:
+            bg_rows = self._bg_rows = self.get_bg_rows(w, h)
         top_pad = max(0, (h - len(content_lines)) // 2)
-        result = Text()
+        changed = self._frame is None or len(self._rows) != h
+        rows = self._rows if len(self._rows) == h else []
         for row in range(h):
             bg_row = bg_rows[row]
             content_idx = row - top_pad
-            if content_idx < 0 or content_idx >= len(content_lines):
-                # Background line not overlapped by content
-                result.append(bg_row, style=BG_STYLE)
+            line = (
+                content_lines[content_idx]
+                if 0 <= content_idx < len(content_lines)
+                else None
+            )
+            if row < len(rows):
+                # Content lines come from cached layers, so identity means unchanged
+                cached_bg_row, cached_line, _ = rows[row]
+                if cached_line is line and cached_bg_row == bg_row:
+                    continue
+                rows[row] = (bg_row, line, self._compose_row(bg_row, line, w))
             else:
-                # Overlay content line over background line
-                line = content_lines[content_idx]
-                plain = line.plain
-                if not plain.strip():
-                    result.append(bg_row, style=BG_STYLE)
-                else:
-                    content_w = cell_len(plain)
-                    left = max(0, (w - content_w) // 2)
-                    right = max(0, w - content_w - left)
-                    result.append(bg_row[:left], style=BG_STYLE)
-                    result.append_text(line)
-                    result.append(
-                        bg_row[left + content_w : left + content_w + right],
-                        style=BG_STYLE,
-                    )
-            if row < h - 1:
-                result.append("\n")
-        return result
+                rows.append((bg_row, line, self._compose_row(bg_row, line, w)))
+            changed = True
+        self._rows = rows
+        if changed or self._frame is None:
+            self._frame = Text("\n").join(composed for _, _, composed in rows)
+        return self._frame
 
-
-@dataclass
-class Star:
-    x: float
-    y: float
-    brightness: float
-    delta: float
+    @staticmethod
+    def _compose_row(bg_row: str, line: Text | None, w: int) -> Text:
+        if line is None or not line.plain.strip():
+            # Background line not overlapped by content
+            return Text(bg_row, style=BG_STYLE)
+        # Overlay content line over background line
+        content_w = cell_len(line.plain)
+        left = max(0, (w - content_w) // 2)
+        right = max(0, w - content_w - left)
+        result = Text()
+        result.append(bg_row[:left], style=BG_STYLE)
+        result.append_text(line)
+        result.append(
+            bg_row[left + content_w : left + content_w + right], style=BG_STYLE
+        )
+        return result
 
 
 class Starfield(Background):
+    """Twinkling stars, stored as a struct of arrays so updating and drawing them is
+    vectorised and costs about the same regardless of terminal size."""
+
     def __init__(self) -> None:
+        super().__init__()
         self._max_stars: int = 0
-        self._stars: list[Star] = []
-
-    @staticmethod
-    def _new_star(w: int, h: int) -> Star:
-        return Star(
-            random.random() * w, random.random() * h, 0.0, random.uniform(0.01, 0.12)
-        )
+        self._rng = np.random.default_rng()
+        self._x = np.empty(0)
+        self._y = np.empty(0)
+        self._brightness = np.empty(0)
+        self._delta = np.empty(0)
+        self._grid = np.empty((0, 0), dtype=np.uint8)  # reused character buffer
 
     def resize(self, w: int, h: int) -> None:
         self._max_stars = int(w * h / 70)
 
+    def _respawn(self, idx: np.ndarray | slice, n: int, w: int, h: int) -> None:
+        self._x[idx] = self._rng.random(n) * w
+        self._y[idx] = self._rng.random(n) * h
+        self._brightness[idx] = 0.0
+        self._delta[idx] = self._rng.uniform(0.01, 0.12, n)
+
     def _update_stars(self, w: int, h: int):
-        if len(self._stars) < self._max_stars:
-            self._stars.append(self._new_star(w, h))
-        elif len(self._stars) > self._max_stars:
-            random.shuffle(self._stars)
-            self._stars = self._stars[: len(self._stars) - 1]
+        n_stars = len(self._x)
+        if n_stars < self._max_stars:
+            for attr in ("_x", "_y", "_brightness", "_delta"):
+                setattr(self, attr, np.append(getattr(self, attr), 0.0))
+            self._respawn(slice(n_stars, None), 1, w, h)
+        elif n_stars > self._max_stars:
+            drop = self._rng.integers(n_stars)
+            for attr in ("_x", "_y", "_brightness", "_delta"):
+                setattr(self, attr, np.delete(getattr(self, attr), drop))
 
     def get_bg_rows(self, w: int, h: int) -> list[str]:
         self._update_stars(w, h)
-        grid = [[" "] * w for _ in range(h)]
-        for i, star in enumerate(self._stars):
-            star.brightness += star.delta
-            if star.brightness >= 1.0:
-                star.delta = -star.delta
-            elif star.brightness <= 0.0:
-                self._stars[i] = self._new_star(w, h)
-            if star.brightness > 0.1:
-                ix, iy = int(star.x), int(star.y)
-                if 0 <= ix < w and 0 <= iy < h:
-                    char = (
-                        "*"
-                        if star.brightness > 0.7
-                        else ("+" if star.brightness > 0.4 else ".")
-                    )
-                    grid[iy][ix] = char
-        return ["".join(row) for row in grid]
+        self._brightness += self._delta
+        np.negative(self._delta, out=self._delta, where=self._brightness >= 1.0)
+        dead = np.flatnonzero(self._brightness <= 0.0)
+        if len(dead):
+            self._respawn(dead, len(dead), w, h)
+
+        if self._grid.shape != (h, w):
+            self._grid = np.empty((h, w), dtype=np.uint8)
+        self._grid.fill(ord(" "))
+        ix, iy = self._x.astype(int), self._y.astype(int)
+        visible = (self._brightness > 0.1) & (ix < w) & (iy < h)
+        brightness = self._brightness[visible]
+        self._grid[iy[visible], ix[visible]] = np.select(
+            [brightness > 0.7, brightness > 0.4], [ord("*"), ord("+")], ord(".")
+        )
+        text = self._grid.tobytes().decode("ascii")
+        return [text[row * w : (row + 1) * w] for row in range(h)]
@@ -1,6 +1,8 @@
 import os
 import sys
+import time
 from pathlib import Path
+from threading import RLock
 from typing import Any
 
 import yaml
@@ -9,18 +11,20 @@ import yaml
 class ConfigManager:
     def __init__(self, reset: bool):
         self.reset = reset
+        # The client ID is updated from the client's transport thread
+        self.lock = RLock()
         if sys.platform == "darwin":
             data_root = Path.home() / "Library"
         elif sys.platform == "win32":
             data_root = os.getenv("LOCALAPPDATA")
         else:
             raise NotImplementedError("Only Windows and MacOS are supported")
-        data_dir = Path(data_root) / "scplay"  # type: ignore
-        data_dir.mkdir(exist_ok=True, parents=True)
-        self.cfg_file = data_dir / "config.yaml"
+        self.data_dir = Path(data_root) / "scplay"  # type: ignore
+        self.data_dir.mkdir(exist_ok=True, parents=True)
+        self.cfg_file = self.data_dir / "config.yaml"
         if not self.cfg_file.exists():
             self.create()
-        self.settings = self.load()
+        self.settings: dict[str, Any] = self.load()
 
     def create(self):
         print(f"Creating config file at '{self.cfg_file}'...")
@@ -43,12 +47,14 @@ class ConfigManager:
             if resp != "yes":
                 print(f"Leaving '{key}' untouched")
                 return self.settings[key]
-        self.settings[key] = input(prompt + " ")
-        self.write()
-        return self.settings[key]
+        value = input(prompt + " ")
+        with self.lock:
+            self.settings[key] = value
+            self.write()
+        return value
 
     def write(self):
-        with open(self.cfg_file, "w") as f:
+        with self.lock, open(self.cfg_file, "w") as f:
             yaml.dump(self.settings, f)
 
     def get_oauth_token(self) -> str:
@@ -58,6 +64,18 @@ class ConfigManager:
             " browser's session storage:",
         )
 
+    def get_client_id(self) -> str | None:
+        return self.settings.get("client-id")
+
+    def get_client_id_timestamp(self) -> float:
+        return self.settings.get("client-id-updated", 0.0)
+
+    def set_client_id(self, client_id: str) -> None:
+        with self.lock:
+            self.settings["client-id"] = client_id
+            self.settings["client-id-updated"] = time.time()
+            self.write()
+
     def get_local_lib(self) -> Path:
         param = "local-lib"
         prompt = "Please provide the location of your local SoundCloud library:"
@@ -70,6 +88,13 @@ class ConfigManager:
             local_lib = Path(self.get(param, prompt))
         return local_lib
 
+    def find_local_lib(self) -> Path | None:
+        """Local library if one was configured, without prompting for it."""
+        if local_lib := self.settings.get("local-lib"):
+            if Path(local_lib).is_dir():
+                return Path(local_lib)
+        return None
+
     def get_classification_config(self) -> Path:
         param = "classification-cfg"
         prompt = (
@@ -1,13 +1,18 @@
 import argparse
+import json
+import os
 import re
-import shutil
-import subprocess
-import tempfile
 import unicodedata
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict, dataclass
 from functools import partial
 from pathlib import Path
+from random import sample
+from threading import BoundedSemaphore
+from typing import Callable, Iterable
 
+from mutagen import MutagenError
+from mutagen.mp3 import MP3
 from rich.progress import (
     BarColumn,
     Progress,
@@ -17,64 +22,137 @@ from rich.progress import (
 )
 
 from soundcloud_player.config_manager import ConfigManager
+from soundcloud_player.hls import afetch_playlist, aiter_segments
+from soundcloud_player.library import META_DIR, LibraryIndex
 from soundcloud_player.soundcloud_client import SoundCloudClient, Track
+from soundcloud_player.transport import Priority
+
+PARTIAL_DIR = META_DIR / "partial"  # unfinished downloads, relative to the library
+QUEUED_PER_JOB = 2  # downloads queued up per worker, beyond the ones running
+RATE_UNITS = {"": 1, "k": 10**3, "m": 10**6, "g": 10**9}
+
+# Orders to download tracks in, given the missing tracks with the newest like first
+DOWNLOAD_ORDERS: dict[str, Callable[[list[Track]], Iterable[Track]]] = {
+    "newest": lambda tracks: tracks,
+    "oldest": lambda tracks: reversed(tracks),
+    "shortest": lambda tracks: sorted(tracks, key=lambda t: t.duration_secs),
+    "longest": lambda tracks: sorted(tracks, key=lambda t: -t.duration_secs),
+    "random": lambda tracks: sample(tracks, len(tracks)),
+}
+
+
+def parse_rate(value: str) -> int:
+    """Parse a rate in bytes per second such as '500k' or '2M' (decimal units)."""
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([kmg]?)b?(?:/s)?\s*", value.lower())
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid rate: '{value}'")
+    return int(float(match.group(1)) * RATE_UNITS[match.group(2)])
 
 
 def sanitise_string(s: str) -> str:
     return re.sub(r"\W+", "_", unicodedata.normalize("NFC", str.lower(s))).strip("_")
 
 
+@dataclass
+class Checkpoint:
+    """Progress of a partial download, everything in the partial file beyond `size`
+    was written after the last checkpoint and is discarded when resuming."""
+
+    n_segments: int
+    done: int = 0  # number of segments completely written
+    size: int = 0
+
+    @classmethod
+    def load(cls, path: Path) -> "Checkpoint | None":
+        try:
+            with open(path, "r") as f:
+                return cls(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def save(self, path: Path) -> None:
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(asdict(self), f)
+        os.replace(tmp_path, path)
+
+
+def verify_download(path: Path, checkpoint: Checkpoint) -> None:
+    if (
+        checkpoint.done != checkpoint.n_segments
+        or path.stat().st_size != checkpoint.size
+    ):
+        raise Exception("Download is incomplete.")
+    try:
+        MP3(path)
+    except MutagenError as e:
+        raise Exception(f"Downloaded file is not a valid mp3: {e}")
+
+
 def download_track(
     track: Track, sc_client: SoundCloudClient, dst_path: Path, progress: Progress
 ) -> Path:
-    url = sc_client.get_streamable_link(track_id=track.id)
+    url = sc_client.get_streamable_link(track_id=track.id, priority=Priority.BULK)
     title = sanitise_string(track.title)
     artist = sanitise_string(track.artist)
     artist = "" if artist in title else artist + "_"
     filename = artist + title + "_" + str(track.id) + ".mp3"
     output_path = dst_path / filename
 
-    task = progress.add_task(filename, total=track.duration_secs)
-    with tempfile.TemporaryDirectory() as tmpdir:
-        temp_path = Path(tmpdir).joinpath("scdl-download.mp3").absolute()
-        with subprocess.Popen(
-            [
-                "ffmpeg",
-                "-i",
-                url,
-                "-c",
-                "copy",
-                str(temp_path),
-                "-loglevel",
-                "error",
-                "-progress",
-                "-",
-            ],
-            universal_newlines=True,
-            bufsize=1,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        ) as p:
-            for line in p.stdout or []:
-                if "out_time=" not in line:
-                    continue
-                h, m, s = line.removeprefix("out_time=").split(".")[0].split(":")
-                progress.update(task, completed=int(h) * 3600 + int(m) * 60 + int(s))
-        dst_path.mkdir(exist_ok=True)
-        shutil.move(temp_path, output_path)
+    partial_dir = dst_path / PARTIAL_DIR
+    partial_dir.mkdir(parents=True, exist_ok=True)
+    part_path = partial_dir / f"{track.id}.mp3.part"
+    checkpoint_path = partial_dir / f"{track.id}.json"
+
+    transport = sc_client.transport
+    segments = transport.run(afetch_playlist(transport, url))
+    checkpoint = Checkpoint.load(checkpoint_path)
+    if (
+        not checkpoint
+        or checkpoint.n_segments != len(segments)
+        or not part_path.exists()
+        or part_path.stat().st_size < checkpoint.size
+    ):
+        # Nothing (usable) to resume from, the stream may have changed in between
+        checkpoint = Checkpoint(n_segments=len(segments))
+    task = progress.add_task(filename, total=len(segments), completed=checkpoint.done)
+    # The segments of the mp3 transcoding are plain MPEG audio, so they can just be
+    # concatenated
+    with open(part_path, "r+b" if checkpoint.done else "wb") as f:
+        f.truncate(checkpoint.size)
+        f.seek(checkpoint.size)
+        pending = segments[checkpoint.done :]
+        for data in transport.iterate(aiter_segments(transport, pending)):
+            f.write(data)
+            f.flush()
+            checkpoint.done += 1
+            checkpoint.size = f.tell()
+            checkpoint.save(checkpoint_path)
+            progress.update(task, advance=1)
+    try:
+        verify_download(part_path, checkpoint)
+    except Exception:
+        # Start from scratch next time
+        part_path.unlink()
+        checkpoint_path.unlink()
+        raise
+    # Only complete downloads ever show up in the library
+    os.replace(part_path, output_path)
+    checkpoint_path.unlink()
     return output_path
 
 
-def download_likes(
-    sc_client: SoundCloudClient, args: argparse.Namespace, cfg_manager: ConfigManager
-):
-    dst_path = cfg_manager.get_local_lib()
-    all_mp3s = list(dst_path.rglob("*.mp3"))
-    all_track_ids = []
-    for file in all_mp3s:
-        matches = re.findall(r"_([0-9]+)\.mp3", str(file.name))
-        if matches:
-            all_track_ids.append(int(matches[0]))
+def download_tracks(
+    sc_client: SoundCloudClient,
+    track_ids: list[int],
+    dst_path: Path,
+    args: argparse.Namespace,
+) -> tuple[list[Path], list[tuple[Track, BaseException]]]:
+    """Download the given tracks (liked ones, newest first) into `dst_path` as
+    configured by the `--jobs`, `--order` and `--max-rate` arguments. Returns the
+    files written and the tracks that failed along with their errors."""
+    tracks = list(sc_client.get_tracks(track_ids))
+    sc_client.transport.limit_bandwidth(args.max_rate)
     with Progress(
         TextColumn("[white]{task.description}[/white]"),
         BarColumn(),
@@ -84,8 +162,53 @@ def download_likes(
         dl_func = partial(
             download_track, sc_client=sc_client, dst_path=dst_path, progress=progress
         )
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            for track in sc_client.get_liked_tracks():
-                if track.id not in all_track_ids:
-                    executor.submit(dl_func, track)
-    print("All liked tracks downloaded")
+        downloads: dict[Future[Path], Track] = {}
+        # Feed the executor through a bounded queue instead of submitting every
+        # missing track up front
+        queued = BoundedSemaphore(args.jobs * (1 + QUEUED_PER_JOB))
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            for track in DOWNLOAD_ORDERS[args.order](tracks):
+                queued.acquire()
+                future = executor.submit(dl_func, track)
+                future.add_done_callback(lambda _: queued.release())
+                downloads[future] = track
+    failed = [(t, e) for f, t in downloads.items() if (e := f.exception())]
+    written = [f.result() for f in downloads if not f.exception()]
+    return written, failed
+
+
+def print_failures(n_downloads: int, failed: list[tuple[Track, BaseException]]):
+    print(
+        f"Downloaded {n_downloads - len(failed)} of {n_downloads} tracks,"
+        f" {len(failed)} failed:"
+    )
+    for track, e in failed:
+        print(f"  {track.artist} - {track.title} ({track.id}): {e}")
+    print("Run the download again to retry them, partial downloads are resumed")
+
+
+def download_likes(
+    sc_client: SoundCloudClient, args: argparse.Namespace, cfg_manager: ConfigManager
+) -> LibraryIndex:
+    """Download liked tracks missing from the local library. Only the difference
+    between the (incrementally synced) like IDs and the library index is looked at,
+    so no metadata is requested for tracks that are already there. Returns the
+    updated index."""
+    dst_path = cfg_manager.get_local_lib()
+    index = LibraryIndex(dst_path)
+    index.refresh()
+    downloaded = index.track_paths().keys()
+    likes = sc_client.get_liked_track_ids()
+    new = [i for i in likes.ids if i not in downloaded]
+    print(f"{len(new)} new liked tracks")
+    written, failed = download_tracks(sc_client, new, dst_path, args)
+    # Only the directory downloads went to has changed and will be listed again
+    index.refresh()
+    for path in written:
+        index.update(path, downloaded=True)
+    index.save()
+    if failed:
+        print_failures(len(written) + len(failed), failed)
+    else:
+        print("All liked tracks downloaded")
+    return index
@@ -0,0 +1,58 @@
+import time
+from collections import deque
+
+MAX_FPS = 20
+MIN_FPS = 5  # lowest rate we back off to while something is actually moving
+IDLE_FPS = 1
+BUDGET_SHARE = 0.5  # share of a frame interval that rendering may take up
+COST_SMOOTHING = 0.2  # weight of the latest frame in the moving average of its cost
+
+
+class FrameGovernor:
+    """Chooses the frame rate of the render loop. Drops to IDLE_FPS while nothing is
+    moving and otherwise runs as fast as MAX_FPS allows while keeping the (smoothed)
+    cost of a frame within BUDGET_SHARE of its interval, backing off down to MIN_FPS
+    when frames are too expensive."""
+
+    def __init__(
+        self,
+        max_fps: float = MAX_FPS,
+        min_fps: float = MIN_FPS,
+        idle_fps: float = IDLE_FPS,
+    ) -> None:
+        self.max_fps = max_fps
+        self.min_fps = min_fps
+        self.idle_fps = idle_fps
+        self.active_fps = max_fps  # rate used while not idle
+        self.target_fps = max_fps  # rate chosen for the next frame
+        self.frame_cost_s = 0.0
+        self._pending_cost_s = 0.0
+        self._frame_times: deque[float] = deque(maxlen=int(max_fps * 2))
+
+    @property
+    def interval_s(self) -> float:
+        return 1 / self.target_fps
+
+    @property
+    def achieved_fps(self) -> float:
+        """Frame rate actually achieved over the last few frames."""
+        if len(self._frame_times) < 2:
+            return 0.0
+        elapsed = self._frame_times[-1] - self._frame_times[0]
+        return (len(self._frame_times) - 1) / elapsed if elapsed else 0.0
+
+    def add_cost(self, cost_s: float) -> None:
+        """Account for work belonging to the current frame that happens elsewhere."""
+        self._pending_cost_s += cost_s
+
+    def frame_done(self, cost_s: float, idle: bool) -> None:
+        self._frame_times.append(time.monotonic())
+        cost_s += self._pending_cost_s
+        self._pending_cost_s = 0.0
+        self.frame_cost_s += COST_SMOOTHING * (cost_s - self.frame_cost_s)
+        budget_s = BUDGET_SHARE / self.active_fps
+        if self.frame_cost_s > budget_s:
+            self.active_fps = max(self.min_fps, self.active_fps * 0.8)
+        elif self.frame_cost_s < budget_s / 2:
+            self.active_fps = min(self.max_fps, self.active_fps + 1)
+        self.target_fps = self.idle_fps if idle else self.active_fps
@@ -0,0 +1,68 @@
+import asyncio
+from collections import deque
+from typing import AsyncGenerator
+from urllib.parse import urljoin
+
+import httpx
+
+from soundcloud_player.transport import AsyncTransport, Priority
+
+SEGMENT_WINDOW = 6  # segments of a single stream fetched ahead of the writer
+MAX_SEGMENT_RETRIES = 3
+
+
+def parse_playlist(text: str, base_url: str) -> list[str]:
+    """Extract the segment URLs from an HLS media playlist."""
+    segments = []
+    for line in map(str.strip, text.splitlines()):
+        if line.startswith("#EXT-X-KEY") and "METHOD=NONE" not in line:
+            raise Exception("Encrypted HLS streams are not supported.")
+        if line and not line.startswith("#"):
+            segments.append(urljoin(base_url, line))
+    return segments
+
+
+async def afetch_playlist(transport: AsyncTransport, url: str) -> list[str]:
+    r = await transport.get(url, priority=Priority.BULK)
+    r.raise_for_status()
+    return parse_playlist(r.text, str(r.url))
+
+
+async def _aget_segment(transport: AsyncTransport, url: str) -> bytes:
+    attempt = 0
+    while True:
+        try:
+            # Segments come from the CDN rather than the API, so they aren't paced
+            r, content = await transport.get_content(
+                url, priority=Priority.BULK, paced=False
+            )
+        except httpx.TransportError:
+            if attempt == MAX_SEGMENT_RETRIES:
+                raise
+            await transport.backoff(None, attempt, paced=False)
+        else:
+            if r.is_success:
+                return content
+            if attempt == MAX_SEGMENT_RETRIES:
+                r.raise_for_status()
+            await transport.backoff(r, attempt, paced=False)
+        attempt += 1
+
+
+async def aiter_segments(
+    transport: AsyncTransport, segments: list[str], window: int = SEGMENT_WINDOW
+) -> AsyncGenerator[bytes]:
+    """Fetch segments concurrently, keeping up to `window` of them in flight, and
+    yield their content in playlist order."""
+    pending = deque(segments)
+    in_flight: deque[asyncio.Task[bytes]] = deque()
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < window:
+                in_flight.append(
+                    asyncio.create_task(_aget_segment(transport, pending.popleft()))
+                )
+            yield await in_flight.popleft()
+    finally:
+        for task in in_flight:
+            task.cancel()
@@ -0,0 +1,212 @@
+import json
+import os
+import re
+import threading
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+TRACK_ID_PATTERN = re.compile(r"_([0-9]+)\.mp3$")  # as written by `download_track`
+# Our own files are kept in a hidden directory of the library root, writing them
+# directly into the root would change its mtime and force a rescan of it on every run
+META_DIR = Path(".scplay")
+INDEX_PATH = META_DIR / "index.json"
+INDEX_VERSION = 1  # bump whenever the manifest format changes
+
+
+def track_id_from_path(path: Path) -> int | None:
+    match = TRACK_ID_PATTERN.search(path.name)
+    return int(match.group(1)) if match else None
+
+
+@dataclass
+class LibraryEntry:
+    track_id: int | None  # None for mp3s that weren't downloaded by us
+    size: int
+    mtime: float
+    album: str | None = None  # album tag as last written by `scplay organise`
+    downloaded: bool = False  # written by `download_track`, not just named like it
+
+
+@dataclass
+class DirEntry:
+    mtime: float
+    subdirs: list[str]
+
+
+class LibraryIndex:
+    """Manifest of all mp3s in a library, persisted in its root so the (possibly
+    network-mounted) tree doesn't have to be walked file by file on every run.
+
+    A directory's mtime changes whenever entries are added to, removed from or renamed
+    within it, so `refresh` only lists directories whose mtime differs from the one
+    recorded and otherwise reuses the files and subdirectories recorded for them.
+    Paths are stored relative to the root."""
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.path = root / INDEX_PATH
+        self.files: dict[str, LibraryEntry] = {}
+        self.dirs: dict[str, DirEntry] = {}
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "r") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return
+        if manifest.get("version") != INDEX_VERSION:
+            return
+        self.files = {k: LibraryEntry(**v) for k, v in manifest["files"].items()}
+        self.dirs = {k: DirEntry(**v) for k, v in manifest["dirs"].items()}
+
+    def save(self) -> None:
+        manifest = dict(
+            version=INDEX_VERSION,
+            files={k: asdict(v) for k, v in self.files.items()},
+            dirs={k: asdict(v) for k, v in self.dirs.items()},
+        )
+        # Write to a temporary file first so a crash never leaves a truncated index
+        self.path.parent.mkdir(exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+
+    def refresh(self) -> None:
+        known_files: dict[str, dict[str, LibraryEntry]] = {}
+        for k, v in self.files.items():
+            known_files.setdefault(_parent(k), {})[k] = v
+        files: dict[str, LibraryEntry] = {}
+        dirs: dict[str, DirEntry] = {}
+        pending = [""]
+        while pending:
+            rel_dir = pending.pop()
+            try:
+                mtime = os.stat(self.root / rel_dir).st_mtime
+            except OSError:
+                continue
+            known = self.dirs.get(rel_dir)
+            if known and known.mtime == mtime:
+                dir_entry = known
+                files |= known_files.get(rel_dir, {})
+            else:
+                dir_entry = DirEntry(mtime=mtime, subdirs=[])
+                with os.scandir(self.root / rel_dir) as it:
+                    for entry in it:
+                        rel_path = _join(rel_dir, entry.name)
+                        if entry.name.startswith("."):
+                            continue
+                        if entry.is_dir():
+                            dir_entry.subdirs.append(rel_path)
+                        elif entry.name.endswith(".mp3") and entry.is_file():
+                            files[rel_path] = self._entry(rel_path, entry.stat())
+            dirs[rel_dir] = dir_entry
+            pending.extend(dir_entry.subdirs)
+        self.files, self.dirs = files, dirs
+
+    def _entry(self, rel_path: str, stat: os.stat_result) -> LibraryEntry:
+        previous = self.files.get(rel_path)
+        return LibraryEntry(
+            track_id=track_id_from_path(Path(rel_path)),
+            size=stat.st_size,
+            mtime=stat.st_mtime,
+            # A file that was only touched (e.g. re-tagged) keeps its album
+            album=previous.album if previous else None,
+            downloaded=previous.downloaded if previous else False,
+        )
+
+    def update(
+        self, path: Path, album: str | None = None, downloaded: bool = False
+    ) -> None:
+        """Record a file that was just written, optionally along with its album and
+        whether it's a download of ours."""
+        rel_path = path.relative_to(self.root).as_posix()
+        entry = self._entry(rel_path, path.stat())
+        self.files[rel_path] = entry
+        if album is not None:
+            entry.album = album
+        if downloaded:
+            entry.downloaded = True
+
+    def move(self, old: Path, new: Path) -> None:
+        old_rel = old.relative_to(self.root).as_posix()
+        entry = self.files.pop(old_rel, None)
+        self.update(
+            new,
+            album=entry.album if entry else None,
+            downloaded=entry.downloaded if entry else False,
+        )
+
+    def paths(self) -> dict[Path, LibraryEntry]:
+        return {self.root / k: v for k, v in self.files.items()}
+
+    def track_paths(self) -> dict[int, Path]:
+        """Map the IDs of all downloaded tracks to their files."""
+        return {
+            v.track_id: self.root / k
+            for k, v in self.files.items()
+            if v.track_id is not None
+        }
+
+    def downloaded_paths(self) -> dict[int, Path]:
+        """Like `track_paths` but only for files `download_track` wrote itself."""
+        return {
+            v.track_id: self.root / k
+            for k, v in self.files.items()
+            if v.track_id is not None and v.downloaded
+        }
+
+
+def _parent(rel_path: str) -> str:
+    return rel_path.rpartition("/")[0]
+
+
+def _join(rel_dir: str, name: str) -> str:
+    return f"{rel_dir}/{name}" if rel_dir else name
+
+
+def scan_library(root: Path) -> dict[int, Path]:
+    """Map the IDs of all downloaded tracks below `root` to their files, using and
+    updating the library's index."""
+    index = LibraryIndex(root)
+    index.refresh()
+    try:
+        index.save()
+    except OSError:
+        pass  # read-only libraries are simply walked again next time
+    return index.track_paths()
+
+
+class LocalLibrary:
+    """Downloaded copies of tracks that can be played instead of streaming them. Tracks
+    are streamed until `scan` (e.g. run from a background worker) has finished, as
+    are files that disappear afterwards (e.g. moved by `scplay organise`)."""
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self._files: dict[int, Path] | None = None
+        self._lock = threading.Lock()
+
+    def scan(self) -> None:
+        files = scan_library(self.root)
+        with self._lock:
+            self._files = files
+
+    def get(self, track_id: int) -> Path | None:
+        """Downloaded copy of a track, if any. Never blocks on the scan, nothing is
+        reported until it has finished."""
+        with self._lock:
+            if self._files is None:
+                return None
+            path = self._files.get(track_id)
+            if path and not path.is_file():
+                del self._files[track_id]
+                return None
+            return path
+
+    def discard(self, track_id: int) -> None:
+        """Stop using a downloaded copy, e.g. because it turned out to be broken."""
+        with self._lock:
+            if self._files is not None:
+                self._files.pop(track_id, None)
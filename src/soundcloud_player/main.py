@@ -1,10 +1,19 @@
 import argparse
 
 from soundcloud_player.config_manager import ConfigManager
-from soundcloud_player.download import download_likes
+from soundcloud_player.download import DOWNLOAD_ORDERS, download_likes, parse_rate
+from soundcloud_player.library import LocalLibrary
 from soundcloud_player.organise import organise_library
 from soundcloud_player.player import Player
 from soundcloud_player.soundcloud_client import SoundCloudClient
+from soundcloud_player.sync import sync_library
+from soundcloud_player.track_cache import TrackCache
+
+
+def positive_int(value: str) -> int:
+    if not value.isdigit() or int(value) < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer: '{value}'")
+    return int(value)
 
 
 def create_parser():
@@ -24,27 +33,98 @@ def create_parser():
         default=30,
         type=int,
     )
+    parser_start.add_argument(
+        "--crossfade",
+        "-c",
+        help="Crossfade between consecutive tracks [seconds]",
+        default=0.0,
+        type=float,
+    )
+    parser_start.add_argument(
+        "--visualiser",
+        "-v",
+        help=(
+            "Visualiser to show, 'spectrum' analyses the actual audio but streams"
+            " every track twice"
+        ),
+        choices=["random", "spectrum"],
+        default="random",
+    )
     parser_start.set_defaults(func=start_player)
 
-    parser_download = subparsers.add_parser("download")
+    # Shared by all subcommands that download tracks
+    download_options = argparse.ArgumentParser(add_help=False)
+    download_options.add_argument(
+        "--jobs",
+        "-j",
+        help="Number of tracks to download at once",
+        default=5,
+        type=positive_int,
+    )
+    download_options.add_argument(
+        "--order",
+        "-o",
+        help="Order to download missing tracks in",
+        choices=list(DOWNLOAD_ORDERS),
+        default="newest",
+    )
+    download_options.add_argument(
+        "--max-rate",
+        help="Bandwidth cap for all downloads together, e.g. '500k' or '2M' [bytes/s]",
+        type=parse_rate,
+    )
+
+    parser_download = subparsers.add_parser("download", parents=[download_options])
     parser_download.set_defaults(func=download_likes)
 
+    parser_sync = subparsers.add_parser("sync", parents=[download_options])
+    parser_sync.set_defaults(func=sync_library)
+    parser_sync.add_argument(
+        "--quarantine",
+        "-q",
+        help="Move tracks that aren't liked anymore out of the library",
+        action="store_true",
+    )
+
     parser_organise = subparsers.add_parser("organise")
     parser_organise.set_defaults(func=organise_library)
     parser_organise.add_argument("--prefix", "-p", help="Album prefix", type=str)
     return parser
 
 
-def start_player(sc_client: SoundCloudClient, args: argparse.Namespace, **kwargs):
-    app = Player(sc_client=sc_client, min_track_length_sec=args.min_track_length * 60)
+def start_player(
+    sc_client: SoundCloudClient,
+    args: argparse.Namespace,
+    cfg_manager: ConfigManager,
+    **kwargs,
+):
+    local_lib = cfg_manager.find_local_lib()
+    app = Player(
+        sc_client=sc_client,
+        min_track_length_sec=args.min_track_length * 60,
+        crossfade_s=args.crossfade,
+        visualiser=args.visualiser,
+        library=LocalLibrary(local_lib) if local_lib else None,
+    )
     app.run()
 
 
 def main():
     args = create_parser().parse_args()
     cfg_mngr = ConfigManager(reset=args.reset_config)
-    sc_client = SoundCloudClient(cfg_mngr.get_oauth_token())
-    args.func(sc_client=sc_client, args=args, cfg_manager=cfg_mngr)
+    sc_client = SoundCloudClient(
+        cfg_mngr.get_oauth_token(),
+        cache=TrackCache(cfg_mngr.data_dir / "tracks.sqlite"),
+        client_id=cfg_mngr.get_client_id(),
+        client_id_timestamp=cfg_mngr.get_client_id_timestamp(),
+        on_client_id_update=cfg_mngr.set_client_id,
+        # Unlikes can only be picked up by listing all likes
+        full_likes_sync=getattr(args, "quarantine", False),
+    )
+    try:
+        args.func(sc_client=sc_client, args=args, cfg_manager=cfg_mngr)
+    finally:
+        sc_client.close()
 
 
 if __name__ == "__main__":
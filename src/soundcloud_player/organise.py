@@ -1,10 +1,18 @@
 import argparse
-from dataclasses import dataclass
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from enum import Enum
 from pathlib import Path
 
+import numpy as np
 import yaml
+from mutagen import MutagenError
 from mutagen.easyid3 import EasyID3
-from mutagen.mp3 import MP3
+from mutagen.id3 import ID3NoHeaderError
+from rapidfuzz import fuzz, process
 from rich import print
 from rich.console import Console
 from rich.progress import (
@@ -15,14 +23,16 @@ from rich.progress import (
     TimeElapsedColumn,
 )
 from rich.table import Table
-from thefuzz import fuzz  # type: ignore
 from unidecode import unidecode
 
 from soundcloud_player.config_manager import ConfigManager
+from soundcloud_player.library import META_DIR, LibraryIndex
 from soundcloud_player.soundcloud_client import SoundCloudClient
 
 SIM_LIMIT = 90
 COLOURS = ["#D35400", "#E67E22", "#F39C12", "#F1C40F", "#2ECC71"]
+CLASSIFICATION_CACHE_PATH = META_DIR / "organise.json"  # relative to the library
+TAG_WORKERS = 8  # files tagged at once, tagging is mostly waiting for storage
 
 
 @dataclass
@@ -44,22 +54,97 @@ class MatchResult:
         return f"[{colour}]{self.similarity}[/{colour}]"
 
 
-def find_best_match(track: Path, all_configs: list[TrackGroup]) -> MatchResult:
-    filename = "_" + unidecode(track.name).lower() + "_"
-    all_matches = [
-        MatchResult(
-            phrase=p,
-            similarity=fuzz.partial_ratio("_" + p.replace(" ", "_") + "_", filename),
-            album=cfg.album,
+class TagOutcome(Enum):
+    UNCHANGED = "unchanged"
+    UPDATED = "updated"
+    FAILED = "failed"
+
+
+@dataclass
+class TagResult:
+    file: Path
+    outcome: TagOutcome
+    error: str | None = None
+
+
+def apply_tags(file: Path, tags: dict[str, str]) -> TagResult:
+    """Write ID3 tags, but only if any of them differ. Only the ID3 header is read
+    rather than scanning the audio as `MP3` does, and saving leaves the audio alone."""
+    try:
+        try:
+            id3 = EasyID3(file)
+        except ID3NoHeaderError:
+            id3 = EasyID3()
+        if all(id3.get(k) == [v] for k, v in tags.items()):
+            return TagResult(file, TagOutcome.UNCHANGED)
+        for k, v in tags.items():
+            id3[k] = v
+        id3.save(file)
+    except (OSError, MutagenError) as e:
+        return TagResult(file, TagOutcome.FAILED, str(e))
+    return TagResult(file, TagOutcome.UPDATED)
+
+
+@dataclass
+class ClassificationCache:
+    """Matches of previous runs by filename, only valid for the exact config they were
+    made with."""
+
+    config_hash: str = ""
+    matches: dict[str, MatchResult] = field(default_factory=dict)
+
+    @classmethod
+    def load(cls, path: Path, config_hash: str) -> "ClassificationCache":
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            if data["config_hash"] == config_hash:
+                return cls(
+                    config_hash,
+                    {k: MatchResult(**v) for k, v in data["matches"].items()},
+                )
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return cls(config_hash)
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(asdict(self), f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+
+def find_best_matches(
+    tracks: list[Path], all_configs: list[TrackGroup]
+) -> list[MatchResult]:
+    """Match all tracks against all phrases in one go, the scoring runs natively and
+    is spread across all cores."""
+    phrases = [(p, cfg.album) for cfg in all_configs for p in cfg.phrases]
+    unsorted = MatchResult(phrase=None, similarity=0, album="Unsorted")
+    if not tracks or not phrases:
+        return [unsorted] * len(tracks)
+    # Similarities are compared as whole numbers, so round before picking the best
+    # match, where the first phrase in the config wins on ties
+    scores = np.rint(
+        process.cdist(
+            ["_" + unidecode(track.name).lower() + "_" for track in tracks],
+            ["_" + p.replace(" ", "_") + "_" for p, _ in phrases],
+            scorer=fuzz.partial_ratio,
+            score_cutoff=SIM_LIMIT - 0.5,
+            workers=-1,
         )
-        for cfg in all_configs
-        for p in cfg.phrases
-    ]
-    all_matches = sorted(all_matches, key=lambda match: match.similarity, reverse=True)
-    best_match = all_matches[0]
-    if best_match.similarity < SIM_LIMIT:
-        return MatchResult(phrase=None, similarity=0, album="Unsorted")
-    return best_match
+    )
+    results = []
+    for row, best in zip(scores, scores.argmax(axis=1)):
+        if not row[best]:
+            results.append(unsorted)
+            continue
+        phrase, album = phrases[best]
+        results.append(
+            MatchResult(phrase=phrase, similarity=int(row[best]), album=album)
+        )
+    return results
 
 
 def organise_library(
@@ -69,40 +154,68 @@ def organise_library(
     cfg_path = cfg_manager.get_classification_config()
 
     # Load config
-    with open(cfg_path, "r") as cfg:
-        all_configs = [
-            TrackGroup(**item) for item in yaml.load_all(cfg, yaml.SafeLoader)
-        ]
-
-    # Find album for all tracks
-    results: dict[Path, MatchResult] = {
-        track: find_best_match(track, all_configs) for track in lib_path.rglob("*.mp3")
-    }
+    with open(cfg_path, "rb") as cfg:
+        cfg_content = cfg.read()
+    all_configs = [
+        TrackGroup(**item) for item in yaml.load_all(cfg_content, yaml.SafeLoader)
+    ]
+
+    # Find album for all tracks, reusing matches from previous runs unless the config
+    # changed in the meantime
+    index = LibraryIndex(lib_path)
+    index.refresh()
+    cache_path = lib_path / CLASSIFICATION_CACHE_PATH
+    cache = ClassificationCache.load(
+        cache_path, hashlib.sha256(cfg_content).hexdigest()
+    )
+    tracks = list(index.paths())
+    new_tracks = [t for t in tracks if t.name not in cache.matches]
+    for track, match in zip(new_tracks, find_best_matches(new_tracks, all_configs)):
+        cache.matches[track.name] = match
+    results: dict[Path, MatchResult] = {t: cache.matches[t.name] for t in tracks}
+    cache.matches = {t.name: match for t, match in results.items()}
+    print(f"Classified {len(new_tracks)} new of {len(tracks)} tracks")
 
-    # Edit mp3 tags
+    # Edit mp3 tags of tracks that don't have the right album yet
     prefix = args.prefix or ""
-    with Progress(
-        TextColumn("[white]{task.description}[/white]"),
-        BarColumn(),
-        TaskProgressColumn(text_format="[white]{task.percentage:>3.0f}%[/white]"),
-        TimeElapsedColumn(),
-    ) as progress:
-        task = progress.add_task("Applying mp3 tags", total=len(results))
-        for file, match in results.items():
-            mp3file = MP3(file, ID3=EasyID3)
-            mp3file["title"] = file.stem
-            mp3file["album"] = prefix + match.album
-            mp3file.save()
+    entries = index.paths()
+    to_tag = {
+        file: dict(title=file.stem, album=prefix + match.album)
+        for file, match in results.items()
+        if entries[file].album != prefix + match.album
+    }
+    tag_results: dict[Path, TagResult] = {}
+    with (
+        Progress(
+            TextColumn("[white]{task.description}[/white]"),
+            BarColumn(),
+            TaskProgressColumn(text_format="[white]{task.percentage:>3.0f}%[/white]"),
+            TimeElapsedColumn(),
+        ) as progress,
+        ThreadPoolExecutor(max_workers=TAG_WORKERS) as executor,
+    ):
+        task = progress.add_task("Applying mp3 tags", total=len(to_tag))
+        for result in executor.map(apply_tags, to_tag, to_tag.values()):
+            if result.outcome is not TagOutcome.FAILED:
+                index.update(result.file, album=to_tag[result.file]["album"])
+            tag_results[result.file] = result
             progress.update(task, advance=1)
 
     # Reorganise folders
     for old, match in results.items():
+        new = lib_path / match.album / old.name
+        if old == new:
+            continue
         (lib_path / match.album).mkdir(exist_ok=True)
-        old.rename(lib_path / match.album / old.name)
+        old.rename(new)
+        index.move(old, new)
     for p in lib_path.iterdir():
         if p.is_dir() and not list(p.iterdir()):
             p.rmdir()
             print(f"Removed {p}")
+    index.refresh()
+    index.save()
+    cache.save(cache_path)
 
     # Display match results
     table = Table(title="Matched Tracks")
@@ -110,8 +223,15 @@ def organise_library(
     table.add_column("Matched Phrase", style="blue")
     table.add_column("Similarity")
     table.add_column("Filename")
+    table.add_column("Tags")
     rows = [
-        (match.album, match.phrase, match.coloured_similarity(), track.name)
+        (
+            match.album,
+            match.phrase,
+            match.coloured_similarity(),
+            track.name,
+            tag_results[track].outcome.value if track in tag_results else "unchanged",
+        )
         for track, match in results.items()
         if match.similarity
     ]
@@ -120,6 +240,14 @@ def organise_library(
     console = Console()
     console.print(table)
 
+    # Display tagging outcomes
+    counts = {o: sum(r.outcome is o for r in tag_results.values()) for o in TagOutcome}
+    counts[TagOutcome.UNCHANGED] += len(results) - len(tag_results)
+    print("\nTags: " + ", ".join(f"{n} {o.value}" for o, n in counts.items()))
+    for result in tag_results.values():
+        if result.outcome is TagOutcome.FAILED:
+            print(f"Could not tag '{result.file.name}': {result.error}")
+
     # Display unsorted items
     unsorted = [track.name for track, match in results.items() if not match.similarity]
     if unsorted:
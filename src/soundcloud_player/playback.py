@@ -0,0 +1,194 @@
+import time
+from enum import Enum, auto
+from queue import Queue
+from threading import Thread
+
+import vlc
+
+from soundcloud_player.spectrum import AudioTap, RingBuffer
+
+VLC_ARGS = (
+    "--intf dummy --no-video --reset-plugins-cache --reset-config "
+    "--network-caching=3000 --file-caching=3000 --live-caching=3000"
+)
+FADE_STEP_S = 0.05
+PRELOAD_MS = 20000  # start buffering the next track this long before the end
+
+
+class Command(Enum):
+    # Issued by the UI
+    LOAD = auto()  # (re)load the current track of the playlist
+    PLAY = auto()
+    PAUSE = auto()
+    SEEK = auto()  # seek to an absolute position in ms
+    SEEK_RELATIVE = auto()  # a relative seek was requested, apply once settled
+    QUIT = auto()
+    # Issued by VLC events of the active player
+    NEAR_END = auto()  # time to preload the next track
+    TRANSITION = auto()  # time to switch to the next track
+    ERROR = auto()
+
+
+CommandQueue = Queue[tuple[Command, int]]
+
+
+class PlaybackEngine:
+    """Double-buffered VLC playback. While the active player plays the current track,
+    the standby player opens and buffers the next one (paused), so switching over at
+    the end of a track is instant. Optionally the two are crossfaded. If given a ring
+    buffer, the audio of the active track is also tapped into it for analysis.
+
+    Rather than being polled, the engine keeps track of playback time through VLC's
+    event manager and reports anything that requires action to `commands`. Event
+    callbacks run on VLC's own threads and must not call back into libvlc, so they
+    only ever update plain attributes and enqueue commands."""
+
+    def __init__(
+        self,
+        commands: CommandQueue,
+        volume: int = 70,
+        crossfade_s: float = 0.0,
+        tap_ring: RingBuffer | None = None,
+    ) -> None:
+        self.commands = commands
+        self.instance = vlc.Instance(VLC_ARGS)
+        self.instance.log_unset()
+        self.tap = AudioTap(self.instance, tap_ring) if tap_ring else None
+        self.active = self.instance.media_player_new()
+        self.standby = self.instance.media_player_new()
+        self._volume = volume
+        self.crossfade_s = crossfade_s
+        self.start_offset_ms = 0  # offset with which the active track was started
+        self.preloaded_mrl: str | None = None
+        self.fading = False
+        self.time_ms = 0  # playback time of the active player as reported by VLC
+        self.length_ms = 0
+        self._near_end_sent = False
+        self._transition_sent = False
+        for player in (self.active, self.standby):
+            events = player.event_manager()
+            for event_type, callback in [
+                (vlc.EventType.MediaPlayerTimeChanged, self._on_time_changed),
+                (vlc.EventType.MediaPlayerLengthChanged, self._on_length_changed),
+                (vlc.EventType.MediaPlayerEndReached, self._on_end_reached),
+                (vlc.EventType.MediaPlayerEncounteredError, self._on_error),
+            ]:
+                events.event_attach(event_type, callback, player)
+
+    def _on_time_changed(self, event: vlc.Event, player: vlc.MediaPlayer) -> None:
+        if player is not self.active:
+            return
+        self.time_ms = event.u.new_time
+        if not self.length_ms:
+            return
+        remaining_ms = self.length_ms - self.time_ms - self.start_offset_ms
+        if remaining_ms < PRELOAD_MS and not self._near_end_sent:
+            self._near_end_sent = True
+            self.commands.put((Command.NEAR_END, 0))
+        if remaining_ms < self.crossfade_s * 1000:
+            self._request_transition()
+
+    def _on_length_changed(self, event: vlc.Event, player: vlc.MediaPlayer) -> None:
+        if player is self.active:
+            self.length_ms = event.u.new_length
+
+    def _on_end_reached(self, event: vlc.Event, player: vlc.MediaPlayer) -> None:
+        if player is self.active:
+            self._request_transition()
+
+    def _on_error(self, event: vlc.Event, player: vlc.MediaPlayer) -> None:
+        if player is self.active:
+            self.commands.put((Command.ERROR, 0))
+
+    def _request_transition(self) -> None:
+        if not self._transition_sent:
+            self._transition_sent = True
+            self.commands.put((Command.TRANSITION, 0))
+
+    def _reset_state(self, time_ms: int = 0, length_ms: int = 0) -> None:
+        self.time_ms = time_ms
+        self.length_ms = length_ms
+        self._near_end_sent = False
+        self._transition_sent = False
+
+    @property
+    def volume(self) -> int:
+        return self._volume
+
+    @volume.setter
+    def volume(self, volume: int) -> None:
+        self._volume = volume
+        if not self.fading:
+            self.active.audio_set_volume(volume)
+
+    def get_time_ms(self) -> tuple[int, int]:
+        return self.time_ms + self.start_offset_ms, self.length_ms
+
+    def load(self, mrl: str, start_ms: int = 0) -> None:
+        media = self.instance.media_new(mrl)
+        media.add_option(f"start-time={int(start_ms / 1000)}")
+        self.start_offset_ms = start_ms
+        self._reset_state()
+        self.active.set_media(media)
+        self.active.audio_set_volume(self._volume)
+        if self.tap:
+            self.tap.load(mrl, start_ms=start_ms)
+
+    def play(self) -> None:
+        self.active.play()
+        if self.tap:
+            self.tap.play()
+
+    def pause(self) -> None:
+        self.active.set_pause(1)
+        if self.tap:
+            self.tap.pause()
+
+    def stop(self) -> None:
+        self.active.stop()
+        self.standby.stop()
+        if self.tap:
+            self.tap.stop()
+
+    def preload(self, mrl: str) -> None:
+        """Open and buffer `mrl` on the standby player without playing it."""
+        if mrl == self.preloaded_mrl or self.fading:
+            return
+        media = self.instance.media_new(mrl)
+        media.add_option("start-paused")
+        self.standby.set_media(media)
+        self.standby.audio_set_volume(0 if self.crossfade_s else self._volume)
+        self.standby.play()
+        if self.tap:
+            self.tap.preload(mrl)
+        self.preloaded_mrl = mrl
+
+    def swap(self) -> bool:
+        """Switch over to the preloaded track, returns False if there is none."""
+        if not self.preloaded_mrl:
+            return False
+        old, self.active, self.standby = self.active, self.standby, self.active
+        if self.tap:
+            self.tap.swap()
+        self.start_offset_ms = 0
+        self.preloaded_mrl = None
+        self._reset_state(
+            time_ms=self.active.get_time() or 0, length_ms=self.active.get_length() or 0
+        )
+        self.active.set_pause(0)
+        if self.crossfade_s:
+            self.fading = True
+            Thread(target=self._crossfade, args=(old,), daemon=True).start()
+        else:
+            self.active.audio_set_volume(self._volume)
+            old.stop()
+        return True
+
+    def _crossfade(self, old: vlc.MediaPlayer) -> None:
+        steps = max(1, int(self.crossfade_s / FADE_STEP_S))
+        for step in range(1, steps + 1):
+            old.audio_set_volume(round(self._volume * (1 - step / steps)))
+            self.active.audio_set_volume(round(self._volume * step / steps))
+            time.sleep(FADE_STEP_S)
+        old.stop()
+        self.fading = False
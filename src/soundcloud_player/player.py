@@ -1,45 +1,74 @@
 import time
+from queue import Empty, Queue
 from random import shuffle
-from typing import Generator, Literal
+from threading import Lock
+from typing import Callable, Generator, Hashable, Literal
 
-import vlc
+import numpy as np
 from rich.text import Text
 from textual import work
 from textual.app import App, ComposeResult
 from textual.containers import Container
+from textual.timer import Timer
 from textual.widget import Widget
 from textual.widgets import Header, Static
 
 from soundcloud_player.background import Background, Starfield
+from soundcloud_player.governor import FrameGovernor
+from soundcloud_player.library import LocalLibrary
+from soundcloud_player.playback import Command, CommandQueue, PlaybackEngine
 from soundcloud_player.soundcloud_client import SoundCloudClient, Track
+from soundcloud_player.spectrum import SpectrumAnalyser
 from soundcloud_player.visualisation import print_braille_multiline, update_viz
 
 SRC_LITERAL = Literal["likes", "feed"]
+VIZ_LITERAL = Literal["random", "spectrum"]
 NAV_WIDTH = 40
 N_ITEMS = 9
+LOOKAHEAD = 2  # number of upcoming tracks to resolve streamable links for
+SEEK_SETTLE_S = 0.5  # wait this long after the last relative seek before applying
+MAX_TRACK_ERRORS = 2  # skip a track after this many playback errors
 YELLOW = "#FFD700"
 BLUE = "#0F3460"
 BRIGHT_BLUE = "#2563EB"
+BLANK = Text("")
 
 
 class PlayerView(Widget):
+    """Renders the player as a stack of layers (playlist window, visualisation,
+    progress bar, volume) on top of an animated background. Each layer is only
+    rebuilt when its inputs change, and the widget is only refreshed when a layer or
+    the background actually changed."""
+
     def __init__(self, player, **kwargs) -> None:
         super().__init__(**kwargs)
         self.player = player
         self.background: Background = Starfield()
+        self._layers: dict[str, tuple[Hashable, list[Text]]] = {}
+        self._layers_changed = True
+        self._content: list[Text] = []
+        self.viz_static = False  # whether the visualisation didn't change last frame
+        self._advance_background = True
 
     def on_resize(self) -> None:
         w, h = self.size.width, self.size.height
         if w and h:
             self.background.resize(w, h)
 
-    def _build_content_lines(self) -> list[Text]:
-        lines: list[str] = [""]
-
-        # Playlist
-        start = max(self.player.playlist_idx[self.player.src] - N_ITEMS // 2, 0)
-        for i in range(start, start + N_ITEMS):
-            if i < 0 or i >= len(self.player.playlist[self.player.src]):
+    def _layer(
+        self, name: str, key: Hashable, build: Callable[[], list[str]]
+    ) -> list[Text]:
+        if (cached := self._layers.get(name)) and cached[0] == key:
+            return cached[1]
+        lines = [Text.from_markup(raw) for raw in build()]
+        self._layers[name] = (key, lines)
+        self._layers_changed = True
+        return lines
+
+    def _playlist_lines(self, start: int, liked: list[bool]) -> list[str]:
+        lines = []
+        for i, is_liked in zip(range(start, start + N_ITEMS), liked):
+            if i >= len(self.player.playlist[self.player.src]):
                 lines.append("")
                 continue
             track = self.player.playlist[self.player.src][i]
@@ -48,49 +77,81 @@ class PlayerView(Widget):
                 title_str = f"[bold]{title_str}[/bold]"
             else:
                 title_str = f"[dim]{title_str}[/dim]"
-            if (
-                self.player.sc_client.liked_track_ids
-                and track.id in self.player.sc_client.liked_track_ids
-            ):
+            if is_liked:
                 title_str = title_str + f" [{BRIGHT_BLUE}](Liked)[/{BRIGHT_BLUE}]"
             lines.append(title_str)
-        lines.append("")
-
-        # Visualisation
-        lines.append(
-            f"[bold {BRIGHT_BLUE}]"
-            + print_braille_multiline(self.player.viz)
-            + f"[/bold {BRIGHT_BLUE}]"
-        )
-        lines.append("")
+        return lines
 
-        # Time
-        current, total = self.player.get_time_ms()
+    def _progress_lines(self, current: int, total: int) -> list[str]:
         max_blocks = NAV_WIDTH - 1
         prog_blocks = round(current / total * max_blocks) if total else 0
         prog_line = "[bold]" + fmt_time(current) + "[/bold] [dim]"
         prog_line += "─" * prog_blocks + "█" + "─" * (max_blocks - prog_blocks)
         prog_line += "[/dim] [bold]" + fmt_time(total) + "[/bold]"
-        lines.append(prog_line)
-        lines.append("")
+        return [prog_line]
+
+    def _build_content_lines(self) -> list[Text]:
+        # Playlist
+        src, idx = self.player.src, self.player.playlist_idx[self.player.src]
+        start = max(idx - N_ITEMS // 2, 0)
+        window = self.player.playlist[src][start : start + N_ITEMS]
+        liked_ids = self.player.sc_client.liked_track_ids
+        liked = [t.id in liked_ids for t in window]
+        liked += [False] * (N_ITEMS - len(liked))
+        playlist = self._layer(
+            "playlist",
+            (src, idx, tuple(t.id for t in window), tuple(liked)),
+            lambda: self._playlist_lines(start, liked),
+        )
+
+        # Visualisation
+        viz_key = self.player.viz.tobytes()
+        self.viz_static = viz_key == self._layers.get("viz", (None,))[0]
+        viz = self._layer(
+            "viz",
+            viz_key,
+            lambda: [
+                f"[bold {BRIGHT_BLUE}]"
+                + print_braille_multiline(self.player.viz)
+                + f"[/bold {BRIGHT_BLUE}]"
+            ],
+        )
+
+        # Time, at the resolution it is displayed at
+        current, total = self.player.get_time_ms()
+        prog_blocks = round(current / total * (NAV_WIDTH - 1)) if total else 0
+        progress = self._layer(
+            "progress",
+            (current // 1000, total // 1000, prog_blocks),
+            lambda: self._progress_lines(current, total),
+        )
 
         # Volume
-        lines.append(f"🔈  {self.player.vlc_player.audio_get_volume()}% 🔊")
-        lines.append("")
+        volume = self.player.engine.volume
+        vol = self._layer("volume", volume, lambda: [f"🔈  {volume}% 🔊"])
 
-        # Convert to Text lines
-        content: list[Text] = [Text.from_markup(raw) for raw in lines]
-        return content
+        return [BLANK, *playlist, BLANK, *viz, BLANK, *progress, BLANK, *vol, BLANK]
 
     def update_view(self) -> None:
         self.player.update_viz()
-        self.refresh()
+        self._content = self._build_content_lines()
+        # The background only animates while music is playing
+        self._advance_background = self.player.is_playing
+        if self._layers_changed or self._advance_background:
+            self._layers_changed = False
+            self.refresh()
 
     def render(self) -> Text:
         w, h = self.size.width, self.size.height
         if not w or not h:
             return Text("")
-        return self.background.render(self._build_content_lines(), w, h)
+        start = time.perf_counter()
+        if not self._content:
+            self._content = self._build_content_lines()
+        advance, self._advance_background = self._advance_background, False
+        result = self.background.render(self._content, w, h, advance=advance)
+        self.player.governor.add_cost(time.perf_counter() - start)
+        return result
 
 
 KEYS = [
@@ -147,38 +208,57 @@ class Player(App):
         ("q", "quit"),
     ]
 
-    def __init__(self, sc_client: SoundCloudClient, min_track_length_sec: int) -> None:
+    def __init__(
+        self,
+        sc_client: SoundCloudClient,
+        min_track_length_sec: int,
+        crossfade_s: float = 0.0,
+        visualiser: VIZ_LITERAL = "random",
+        library: LocalLibrary | None = None,
+    ) -> None:
         super().__init__()
         self.theme = "textual-dark"
 
         # Soundcloud setup
         self.sc_client = sc_client
+        self.library = library  # downloaded tracks, played instead of streaming them
         self.playlist_gen: dict[SRC_LITERAL, Generator[Track]] = {
             "likes": self.sc_client.get_liked_tracks(),
             "feed": self.sc_client.get_feed(min_track_length_sec=min_track_length_sec),
         }
         self.playlist: dict[SRC_LITERAL, list[Track]] = {"likes": [], "feed": []}
         self.playlist_idx: dict[SRC_LITERAL, int] = {"likes": 0, "feed": 0}
+        # Playlist generators are expanded from workers, one lock each so fetching the
+        # likes doesn't hold up the feed
+        self.playlist_locks: dict[SRC_LITERAL, Lock] = {"likes": Lock(), "feed": Lock()}
 
         # Set initial state
         self.src: SRC_LITERAL = "feed"  # which playlist to show/play
-        self.current_time_ms = 0  # track time in ms from the start of the track
-        self.last_start_time_ms = 0  # offset with which the track was last started
         self.is_playing = True  # whether the player is currently playing or paused
-        self.viz: list[float] | None = None  # current visualisation state
+        self.viz: np.ndarray | None = None  # current visualisation state
+        self.analyser = (
+            SpectrumAnalyser(n_bands=NAV_WIDTH * 2)
+            if visualiser == "spectrum"
+            else None
+        )
         self.update_viz(reset=True)
         self.pending_seek_delta_ms = 0  # temporary store for seek deltas
         self.pending_seek_timestamp = time.time()  # timestamp of the latest seek action
+        self.track_errors = 0  # playback errors encountered for the current track
+
+        # Rendering
+        self.governor = FrameGovernor()
+        self.frame_timer: Timer | None = None
+        self.frame_timer_fps = 0.0
 
         # VLC setup
-        self.vlc_instance = vlc.Instance(
-            "--intf dummy --no-video --reset-plugins-cache --reset-config "
-            "--network-caching=3000 --file-caching=3000 --live-caching=3000"
+        self.commands: CommandQueue = Queue()
+        self.engine = PlaybackEngine(
+            commands=self.commands,
+            volume=70,
+            crossfade_s=crossfade_s,
+            tap_ring=self.analyser.ring if self.analyser else None,
         )
-        self.vlc_instance.log_unset()
-        self.vlc_player = self.vlc_instance.media_player_new()
-        self.vlc_player.audio_set_volume(70)
-        self.vlc_active = True
 
     def compose(self) -> ComposeResult:
         yield Header(show_clock=True)
@@ -188,105 +268,233 @@ class Player(App):
             yield PlayerView(self, id="playlist")
 
     def on_mount(self) -> None:
-        self.switch_playlist(self.src)
         self.update_display()
-        self.set_interval(0.05, self.update_display)
+        self.schedule_frames()
+        self.switch_playlist(self.src)
         self.run_vlc()
+        if self.library:
+            self.scan_library(self.library)
 
     def on_unmount(self) -> None:
-        self.vlc_active = False
+        self.commands.put((Command.QUIT, 0))
+        if self.analyser:
+            self.analyser.stop()
 
     def update_display(self) -> None:
         self.query_one(PlayerView).update_view()
 
+    def schedule_frames(self) -> None:
+        """(Re)start the render loop at the frame rate chosen by the governor."""
+        if self.frame_timer and self.frame_timer_fps == self.governor.target_fps:
+            return
+        if self.frame_timer:
+            self.frame_timer.stop()
+        self.frame_timer_fps = self.governor.target_fps
+        self.frame_timer = self.set_interval(
+            self.governor.interval_s, self.render_frame
+        )
+
+    def render_frame(self) -> None:
+        start = time.perf_counter()
+        self.update_display()
+        idle = (
+            not self.is_playing
+            or not self.app_focus
+            or self.query_one(PlayerView).viz_static
+        )
+        self.governor.frame_done(time.perf_counter() - start, idle=idle)
+        self.schedule_frames()
+
+    def on_key(self) -> None:
+        # Reflect the outcome of key presses right away, even at idle frame rates
+        self.call_later(self.update_display)
+
     @work(exclusive=True, thread=True)
     def run_vlc(self) -> None:
-        while self.vlc_active:
+        """Playback controller, sleeps until the UI or VLC ask for something."""
+        while True:
+            timeout = None
+            if self.pending_seek_delta_ms:
+                settle_time = self.pending_seek_timestamp + SEEK_SETTLE_S
+                timeout = max(0.0, settle_time - time.time())
+            try:
+                command, arg = self.commands.get(timeout=timeout)
+            except Empty:
+                # Apply accumulated seek delta now that no seek happened for a while
+                current_ms, total_ms = self.get_time_ms()
+                command = Command.SEEK
+                arg = max(0, min(current_ms + self.pending_seek_delta_ms, total_ms))
+                self.pending_seek_delta_ms = 0
+            if command is Command.QUIT:
+                self.engine.stop()
+                return
             try:
-                if self.is_playing:
-                    media = self.vlc_player.get_media()
-                    # Get current and expected URLs to determine if we need to (re)start
-                    # (streamable URLs are cached with a TTL as SoundCloud seems to
-                    # update them periodically so they stop working at some point)
-                    act_url = media.get_mrl() if media else None
-                    exp_url = self.sc_client.get_streamable_link(
-                        self.playlist[self.src][self.playlist_idx[self.src]].id
-                    )
-                    # Get current/total track time
-                    current_ms, total_ms = self.get_time_ms()
-
-                    # Apply accumulated seek delta if no seek has happened for a while
-                    if (
-                        self.pending_seek_delta_ms != 0
-                        and time.time() - self.pending_seek_timestamp > 0.5
-                    ):
-                        self.current_time_ms = max(
-                            0,
-                            min(
-                                self.current_time_ms + self.pending_seek_delta_ms,
-                                total_ms,
-                            ),
-                        )
-                        self.pending_seek_delta_ms = 0
-
-                    # (Re)start track if the URL has changed and/or playback needs to
-                    # skip to a different time
-                    diff = abs(self.current_time_ms - current_ms) / 1000
-                    if act_url != exp_url or diff > 3:
-                        media = self.vlc_instance.media_new(exp_url)
-                        media.add_option(
-                            f"start-time={int(self.current_time_ms / 1000)}"
-                        )
-                        self.last_start_time_ms = self.current_time_ms
-                        self.vlc_player.set_media(media)
-                    self.vlc_player.play()
-
-                    # Retrieve new track time
-                    current_ms, total_ms = self.get_time_ms()
-
-                    # If we're near the end of the track, switch to the next one
-                    if total_ms and total_ms - current_ms < 0.5:
-                        self.call_from_thread(
-                            self.change_track, new_idx=self.playlist_idx[self.src] + 1
-                        )
-                        continue
-
-                    # Update current timekeeping outside of VLC
-                    self.current_time_ms = current_ms
-                # Pause track if requested
-                elif not self.is_playing and self.vlc_player.is_playing():
-                    self.vlc_player.pause()
-                time.sleep(0.2)
+                self.handle_command(command, arg)
             except Exception as e:
                 self.call_from_thread(self.notify, str(e), severity="error")
-                time.sleep(1)
+
+    @work(thread=True, group="library")
+    def scan_library(self, library: LocalLibrary) -> None:
+        """Look for downloaded tracks without holding up playback, which streams
+        everything until this is done."""
+        try:
+            library.scan()
+        except OSError as e:
+            self.call_from_thread(self.notify, str(e), severity="error")
+
+    def handle_command(self, command: Command, arg: int) -> None:
+        if command is Command.PAUSE:
+            self.engine.pause()
+        elif command is Command.PLAY:
+            self.engine.play()
+        elif command is Command.LOAD:
+            self.track_errors = 0
+            self.pending_seek_delta_ms = 0
+            mrl = self.track_mrl(self.current_track().id)
+            # Skipping to the preloaded track? Use it instead of reloading
+            if mrl != self.engine.preloaded_mrl or not self.engine.swap():
+                self.engine.load(mrl)
+            if self.is_playing:
+                self.engine.play()
+        elif command is Command.SEEK:
+            # (Re)start the track at the requested position, streamable URLs are
+            # cached with a TTL so this also picks up a fresh URL if needed
+            self.engine.load(self.track_mrl(self.current_track().id), start_ms=arg)
+            if self.is_playing:
+                self.engine.play()
+        elif command is Command.NEAR_END:
+            # Buffer the next track on the standby player ahead of time
+            next_idx = self.playlist_idx[self.src] + 1
+            if next_idx < len(self.playlist[self.src]):
+                next_id = self.playlist[self.src][next_idx].id
+                self.engine.preload(self.track_mrl(next_id))
+        elif command is Command.TRANSITION:
+            # Switch to the next track, without reloading it if it was preloaded. The
+            # playlist may have been shuffled or sorted since, so check it still is
+            next_idx = self.playlist_idx[self.src] + 1
+            swapped = False
+            if next_idx < len(self.playlist[self.src]):
+                mrl = self.track_mrl(self.playlist[self.src][next_idx].id)
+                swapped = mrl == self.engine.preloaded_mrl and self.engine.swap()
+            self.call_from_thread(self.change_track, new_idx=next_idx, load=not swapped)
+        elif command is Command.ERROR:
+            # SoundCloud seems to update streamable URLs periodically so they stop
+            # working at some point, so try again with a fresh one
+            self.track_errors += 1
+            track = self.current_track()
+            if self.track_errors >= MAX_TRACK_ERRORS:
+                self.call_from_thread(
+                    self.notify,
+                    f"Could not play '{fmt_track(track)}'",
+                    severity="error",
+                )
+                self.call_from_thread(
+                    self.change_track, new_idx=self.playlist_idx[self.src] + 1
+                )
+                return
+            if self.library:
+                # A broken download, stream the track instead
+                self.library.discard(track.id)
+            self.sc_client.forget_streamable_link(track.id)
+            current_ms, _ = self.get_time_ms()
+            self.commands.put((Command.SEEK, current_ms))
+
+    def track_mrl(self, track_id: int) -> str:
+        """Location to play a track from, preferring a downloaded copy."""
+        if self.library and (path := self.library.get(track_id)):
+            return path.absolute().as_uri()
+        return self.sc_client.get_streamable_link(track_id)
+
+    def current_track(self) -> Track:
+        return self.playlist[self.src][self.playlist_idx[self.src]]
 
     def switch_playlist(self, source: SRC_LITERAL) -> None:
-        self.is_playing = False
         self.src = source
         if not self.playlist[source]:
-            self.expand_current_playlist(count=N_ITEMS)
-        self.change_track(self.playlist_idx[self.src])
+            # Fetch the first tracks in the background to keep the UI responsive
+            self.pause()
+            self.sub_title = "Loading..."
+            self.load_playlist(source)
+            return
         self.is_playing = True
+        self.change_track(self.playlist_idx[self.src])
 
-    def expand_current_playlist(self, count: int) -> None:
-        new_items = [
-            track
-            for track in [next(self.playlist_gen[self.src], None) for i in range(count)]
-            if track is not None
-        ]
-        self.playlist[self.src].extend(new_items)
-
-    def set_time(self, time_ms):
-        self.current_time_ms = time_ms
+    @work(thread=True, group="playlist")
+    def load_playlist(self, source: SRC_LITERAL) -> None:
+        try:
+            self.expand_playlist(source, count=N_ITEMS)
+        except Exception as e:
+            self.call_from_thread(self.notify, str(e), severity="error")
+        self.call_from_thread(self.on_playlist_loaded, source)
 
-    def change_track(self, new_idx: int) -> None:
-        self.playlist_idx[self.src] = new_idx
+    def on_playlist_loaded(self, source: SRC_LITERAL) -> None:
+        if source != self.src:
+            return
+        if not self.playlist[source]:
+            self.sub_title = "No tracks found"
+            return
+        self.switch_playlist(source)
+
+    @work(thread=True, group="playlist")
+    def extend_playlist(
+        self, source: SRC_LITERAL, count: int, pending_idx: int | None = None
+    ) -> None:
+        """Fetch more tracks in the background, switching to `pending_idx` once it
+        has been fetched if the requested track wasn't there yet."""
+        try:
+            self.expand_playlist(source, count=count)
+        except Exception as e:
+            self.call_from_thread(self.notify, str(e), severity="error")
+        if pending_idx is not None:
+            self.call_from_thread(self.on_playlist_extended, source, pending_idx)
+
+    def on_playlist_extended(self, source: SRC_LITERAL, pending_idx: int) -> None:
+        if source != self.src:
+            return
+        if pending_idx < len(self.playlist[source]):
+            self.change_track(pending_idx)
+        else:
+            self.sub_title = "No more tracks"
+
+    def expand_playlist(self, source: SRC_LITERAL, count: int) -> None:
+        with self.playlist_locks[source]:
+            new_items = [
+                track
+                for track in [
+                    next(self.playlist_gen[source], None) for i in range(count)
+                ]
+                if track is not None
+            ]
+            self.playlist[source].extend(new_items)
+
+    def set_time(self, time_ms: int) -> None:
+        self.pending_seek_delta_ms = 0
+        self.commands.put((Command.SEEK, time_ms))
+
+    def change_track(self, new_idx: int, load: bool = True) -> None:
+        if not self.playlist[self.src]:
+            return
+        # Fetching more tracks may block on the network, never do it on the UI thread
         if (missing := new_idx + N_ITEMS - len(self.playlist[self.src])) > 0:
-            self.expand_current_playlist(count=missing)
-        self.current_time_ms = 0
+            beyond_end = new_idx >= len(self.playlist[self.src])
+            self.extend_playlist(
+                self.src, count=missing, pending_idx=new_idx if beyond_end else None
+            )
+            if beyond_end:
+                self.sub_title = "Loading..."
+                return
+        self.playlist_idx[self.src] = new_idx
+        if load:
+            self.commands.put((Command.LOAD, 0))
         self.update_viz(reset=True)
         self.update_display()
+        self.sc_client.prefetch_streamable_links(
+            [
+                t.id
+                for t in self.playlist[self.src][new_idx + 1 : new_idx + 1 + LOOKAHEAD]
+                if not (self.library and self.library.get(t.id))
+            ]
+        )
         self.sub_title = (
             "Now Playing:"
             f" {fmt_track(self.playlist[self.src][self.playlist_idx[self.src]])}"
@@ -294,9 +502,11 @@ class Player(App):
 
     def play(self) -> None:
         self.is_playing = True
+        self.commands.put((Command.PLAY, 0))
 
     def pause(self) -> None:
         self.is_playing = False
+        self.commands.put((Command.PAUSE, 0))
 
     def seek_to_fraction(self, fraction: float) -> None:
         _, total = self.get_time_ms()
@@ -308,18 +518,20 @@ class Player(App):
     def seek_relative(self, delta_s: int) -> None:
         self.pending_seek_timestamp = time.time()
         self.pending_seek_delta_ms += delta_s * 1000
+        self.commands.put((Command.SEEK_RELATIVE, 0))
 
     def get_time_ms(self) -> tuple[int, int]:
-        current = (self.vlc_player.get_time() or 0) + self.last_start_time_ms
-        total = self.vlc_player.get_length() or 0
-        return current, total
+        return self.engine.get_time_ms()
 
     def update_viz(self, reset: bool = False):
-        if reset or not self.viz:
-            self.viz = [0.0] * NAV_WIDTH * 2
+        if reset or self.viz is None:
+            self.viz = np.zeros(NAV_WIDTH * 2)
             return
         if not self.is_playing:
             return
+        if self.analyser:
+            self.viz = self.analyser.bands
+            return
         self.viz = update_viz(self.viz)
         return
 
@@ -330,7 +542,7 @@ class Player(App):
             self.play()
 
     def action_shuffle(self) -> None:
-        if self.src == "likes":
+        if self.src == "likes" or not self.playlist[self.src]:
             return  # TODO
         start = self.playlist[self.src][self.playlist_idx[self.src]]
         rest = (
@@ -342,6 +554,8 @@ class Player(App):
         self.playlist_idx[self.src] = 0
 
     def action_alphabetic_sort(self) -> None:
+        if not self.playlist[self.src]:
+            return
         current_track = self.playlist[self.src][self.playlist_idx[self.src]]
         self.playlist[self.src].sort(key=lambda tr: fmt_track(tr))
         for i, track in enumerate(self.playlist[self.src]):
@@ -359,12 +573,10 @@ class Player(App):
         self.change_track(self.playlist_idx[self.src] - 1)
 
     def action_volume_down(self) -> None:
-        vol = max(0, self.vlc_player.audio_get_volume() - 5)
-        self.vlc_player.audio_set_volume(vol)
+        self.engine.volume = max(0, self.engine.volume - 5)
 
     def action_volume_up(self) -> None:
-        vol = min(100, self.vlc_player.audio_get_volume() + 5)
-        self.vlc_player.audio_set_volume(vol)
+        self.engine.volume = min(100, self.engine.volume + 5)
 
     def action_seek_backward(self) -> None:
         self.seek_relative(delta_s=-10)
@@ -1,15 +1,29 @@
-import json
+import asyncio
+import base64
+import binascii
 import re
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from contextlib import aclosing
 from dataclasses import dataclass
-from random import shuffle
-from typing import Any, Generator
+from random import randint, shuffle
+from typing import Any, AsyncGenerator, Callable, Generator, Iterator
+from urllib.parse import parse_qs, urlsplit
 
-import requests
-from requests import HTTPError
+import httpx
 
-TIMEOUT_S = 3
+from soundcloud_player.track_cache import TrackCache
+from soundcloud_player.transport import AsyncTransport, Priority, SchedulerStats
+
+TRACK_BATCH_SIZE = 50  # maximum number of IDs the tracks endpoint accepts per call
+MIN_PREFETCH_WINDOW = 1  # bounds for the number of track batches resolved ahead
+MAX_PREFETCH_WINDOW = 8
+CLIENT_ID_MIN_AGE_S = 60  # don't re-scrape a client ID that was only just scraped
+LINK_CACHE_SIZE = 64  # number of streamable links kept around
+LINK_TTL_S = 3600  # fallback lifetime of links without a recognisable expiry
+LINK_EXPIRY_MARGIN_S = 60  # stop using links this long before they expire
+LIKES_FULL_SYNC_S = 24 * 3600  # resync all likes (picking up unlikes) this often
 
 
 @dataclass
@@ -27,136 +41,472 @@ class Track:
     def __hash__(self) -> int:
         return hash(self.id)
 
+    @classmethod
+    def from_json(cls, t: dict) -> "Track":
+        return cls(
+            id=t["id"],
+            title=t["title"],
+            artist=t["user"]["username"],
+            duration_secs=t["duration"] / 1000,
+        )
+
+
+def link_expiry(link: str) -> float | None:
+    """Extract the expiry timestamp from a signed (CloudFront) streamable link."""
+    query = parse_qs(urlsplit(link).query)
+    if expires := query.get("Expires", query.get("expires")):
+        try:
+            return float(expires[0])
+        except ValueError:
+            return None
+    if policy := query.get("Policy"):
+        # CloudFront uses a URL-safe flavour of base64 for its custom policies
+        try:
+            decoded = base64.b64decode(policy[0].translate(str.maketrans("-_~", "+=/")))
+        except (binascii.Error, ValueError):
+            return None
+        if match := re.search(rb'"AWS:EpochTime"\s*:\s*(\d+)', decoded):
+            return float(match.group(1))
+    return None
+
+
+class LinkCache:
+    """Bounded LRU cache of streamable links which drops links shortly before the
+    expiry embedded in their signature."""
+
+    def __init__(self, max_size: int = LINK_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self._links: OrderedDict[int, tuple[str, float]] = OrderedDict()
+
+    def get(self, track_id: int) -> str | None:
+        if not (cached := self._links.get(track_id)):
+            return None
+        link, expires_at = cached
+        if time.time() > expires_at - LINK_EXPIRY_MARGIN_S:
+            del self._links[track_id]
+            return None
+        self._links.move_to_end(track_id)
+        return link
+
+    def discard(self, track_id: int) -> None:
+        self._links.pop(track_id, None)
+
+    def put(self, track_id: int, link: str) -> None:
+        expires_at = link_expiry(link) or time.time() + LINK_TTL_S
+        self._links[track_id] = (link, expires_at)
+        self._links.move_to_end(track_id)
+        while len(self._links) > self.max_size:
+            self._links.popitem(last=False)
+
+
+class LikedIndex:
+    """Liked track IDs with O(1) membership. `ids` keeps the order of the API (newest
+    like first), iterating yields the shuffled play order, which stays stable across
+    incremental syncs: new likes are slotted into it at random positions."""
+
+    def __init__(self) -> None:
+        self.ids: list[int] = []
+        self.play_order: list[int] = []
+        self._members: set[int] = set()
+
+    def __contains__(self, track_id: object) -> bool:
+        return track_id in self._members
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.play_order)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def newest(self) -> int | None:
+        return self.ids[0] if self.ids else None
+
+    def replace(self, ids: list[int]) -> None:
+        play_order = ids.copy()
+        shuffle(play_order)
+        self.ids, self.play_order, self._members = ids, play_order, set(ids)
+
+    def add_newer(self, ids: list[int]) -> None:
+        """Add likes that are newer than any known one, given newest first."""
+        new_ids = [i for i in dict.fromkeys(ids) if i not in self._members]
+        self._members.update(new_ids)
+        self.ids[:0] = new_ids
+        for i in new_ids:
+            self.play_order.insert(randint(0, len(self.play_order)), i)
+
 
 class SoundCloudClient:
-    def __init__(self, oauth_token: str) -> None:
+    """SoundCloud API client. All requests run on the event loop of a shared
+    `AsyncTransport`; the `a`-prefixed coroutines are the actual implementation and
+    the plain methods are thin synchronous facades for callers on other threads."""
+
+    def __init__(
+        self,
+        oauth_token: str,
+        cache: TrackCache | None = None,
+        client_id: str | None = None,
+        client_id_timestamp: float = 0.0,
+        on_client_id_update: Callable[[str], None] | None = None,
+        full_likes_sync: bool = False,
+    ) -> None:
+        self.cache = cache
+        self.on_client_id_update = on_client_id_update
         self.base_url = "https://api-v2.soundcloud.com/"
-        self.session = requests.session()
-        self.session.headers = {
-            "User-Agent": (
-                "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:140.0) Gecko/20100101"
-                " Firefox/140.0"
-            ),
-            "Authorization": f"OAuth {oauth_token}",
-        }
-        self.update_client_id()
-        self.user_id = self.get("me")["id"]
-        self.streamable_links: dict[int, tuple[str, float]] = {}
-        self.liked_track_ids: list[int] = []
-        self.update_liked_track_ids()
+        self.transport = AsyncTransport(
+            headers={
+                "User-Agent": (
+                    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:140.0)"
+                    " Gecko/20100101 Firefox/140.0"
+                )
+            }
+        )
+        self.auth_headers = {"Authorization": f"OAuth {oauth_token}"}
+        self.client_id_lock = asyncio.Lock()
+        self.client_id = client_id
+        self.client_id_timestamp = client_id_timestamp  # when it was scraped
+        # Both only ever touched from the transport's event loop
+        self.streamable_links = LinkCache()
+        self.link_requests: dict[int, asyncio.Task[str]] = {}
+        self.liked_track_ids = LikedIndex()
+        self.likes_synced_at = 0.0  # time of the last full sync of the likes
+        # Anything requiring the API is resolved in the background so constructing
+        # the client never blocks; a missing client ID is scraped on first use
+        self.user_id_future: Future[dict] = self.transport.submit(self.aget("me"))
+        self.likes_future: Future[None] = self.transport.submit(
+            self._aload_liked_track_ids(full=full_likes_sync)
+        )
 
-    def update_client_id(self) -> None:
+    @property
+    def user_id(self) -> int:
+        return self.user_id_future.result()["id"]
+
+    async def auser_id(self) -> int:
+        return (await asyncio.wrap_future(self.user_id_future))["id"]
+
+    @property
+    def request_stats(self) -> SchedulerStats:
+        return self.transport.scheduler.stats
+
+    def close(self) -> None:
+        self.transport.close()
+
+    async def aupdate_client_id(self) -> None:
         assets_script_regex = re.compile(
             r"src=\"(https:\/\/a-v2\.sndcdn\.com/assets/[^\.]+\.js)\""
         )
         client_id_regex = re.compile(r"client_id:\"([^\"]+)\"")
-        r = requests.get("https://soundcloud.com", timeout=TIMEOUT_S)
+        # Public pages, so no credentials are sent along
+        r = await self.transport.get("https://soundcloud.com")
         r.raise_for_status()
         matches = assets_script_regex.findall(r.text)
         if not matches:
             raise Exception("Could not generate client ID - no asset scripts found")
         url = matches[-1]
-        r = requests.get(url, timeout=TIMEOUT_S)
+        r = await self.transport.get(url)
         r.raise_for_status()
         client_id = client_id_regex.search(r.text)
         if not client_id:
             raise Exception(f"Could not find client_id in script '{url}'")
-        self.session.params |= dict(client_id=client_id.group(1))  # type: ignore
+        self.client_id = client_id.group(1)
+        self.client_id_timestamp = time.time()
+        if self.on_client_id_update:
+            # Persisting it may block on disk I/O, keep that off the event loop
+            await asyncio.to_thread(self.on_client_id_update, self.client_id)
 
-    def _get_with_backoff(self, url: str, **kwargs) -> requests.Response:
+    def update_client_id(self) -> None:
+        self.transport.run(self.aupdate_client_id())
+
+    async def _refresh_client_id(self, failed_client_id: str | None) -> bool:
+        """Re-scrape the client ID after a request using `failed_client_id` was
+        rejected, or if we don't have one yet. Returns whether the request is worth
+        retrying."""
+        async with self.client_id_lock:
+            if self.client_id != failed_client_id:
+                return True  # another request already refreshed it
+            if time.time() - self.client_id_timestamp < CLIENT_ID_MIN_AGE_S:
+                return False  # fresh client ID, so that's not what's wrong here
+            await self.aupdate_client_id()
+            return True
+
+    async def _get_with_backoff(
+        self,
+        url: str,
+        params: dict[str, Any] | None = None,
+        priority: Priority = Priority.INTERACTIVE,
+    ) -> httpx.Response:
         max_retries = 3
+        client_id_refreshed = False
+        if self.client_id is None:
+            await self._refresh_client_id(None)
         for attempt in range(max_retries + 1):
-            r = self.session.get(url, timeout=TIMEOUT_S, **kwargs)
-            if r.ok or attempt == max_retries:
+            client_id = self.client_id
+            r = await self.transport.get(
+                url,
+                priority=priority,
+                params=(params or {}) | dict(client_id=client_id),
+                headers=self.auth_headers,
+            )
+            if (
+                r.status_code in (401, 403)
+                and not client_id_refreshed
+                and await self._refresh_client_id(client_id)
+            ):
+                # The cached client ID has most likely expired
+                client_id_refreshed = True
+                continue
+            if r.is_success or attempt == max_retries:
                 r.raise_for_status()
                 return r
-            time.sleep(0.5 * (2**attempt))
+            await self.transport.backoff(r, attempt)
         return r
 
-    def get(self, path: str, **params) -> dict:
-        r = self._get_with_backoff(self.base_url + path, params=params)
-        return json.loads(r.text)
+    async def aget(
+        self, path: str, priority: Priority = Priority.INTERACTIVE, **params
+    ) -> dict:
+        r = await self._get_with_backoff(
+            self.base_url + path, params=params, priority=priority
+        )
+        return r.json()
+
+    def get(
+        self, path: str, priority: Priority = Priority.INTERACTIVE, **params
+    ) -> dict:
+        return self.transport.run(self.aget(path, priority=priority, **params))
 
-    def get_collection(self, path: str, **params) -> Generator[Any]:
+    async def _aget_pages(
+        self, path: str, priority: Priority = Priority.INTERACTIVE, **params
+    ) -> AsyncGenerator[list[Any]]:
         next_url = None
         while True:
-            r = self._get_with_backoff(
-                next_url or (self.base_url + path), params=None if next_url else params
+            r = await self._get_with_backoff(
+                next_url or (self.base_url + path),
+                params=None if next_url else params,
+                priority=priority,
             )
             data = r.json()
-            for resource in data["collection"]:
-                yield resource
+            yield data["collection"]
             next_url = data.get("next_href", None)
             if not next_url:
                 break
 
-    def get_streamable_link(self, track_id: int) -> str:
-        now = time.time()
-        if cached := self.streamable_links.get(track_id, None):
-            link, from_time = cached
-            if now - from_time < 3600:
-                return link
-        track = self.get(f"tracks/{track_id}")
-        transcoding = None
+    async def aget_collection(
+        self, path: str, priority: Priority = Priority.INTERACTIVE, **params
+    ) -> AsyncGenerator[Any]:
+        async for page in self._aget_pages(path, priority=priority, **params):
+            for resource in page:
+                yield resource
+
+    def get_collection(
+        self, path: str, priority: Priority = Priority.INTERACTIVE, **params
+    ) -> Generator[Any]:
+        # Hop over to the event loop once per page rather than once per resource
+        pages = self._aget_pages(path, priority=priority, **params)
+        for page in self.transport.iterate(pages):
+            yield from page
+
+    @staticmethod
+    def _find_transcoding(track: dict) -> dict:
         for t in track["media"]["transcodings"]:
             if "mp3" in t["preset"] and t["format"]["protocol"] == "hls":
-                transcoding = t
-                break
-        if not transcoding:
-            raise Exception("No usable transcoding found.")
-        r = self.session.get(transcoding["url"], timeout=TIMEOUT_S)
-        r.raise_for_status()
+                return t
+        raise Exception("No usable transcoding found.")
+
+    async def aget_streamable_link(
+        self, track_id: int, priority: Priority = Priority.INTERACTIVE
+    ) -> str:
+        if link := self.streamable_links.get(track_id):
+            return link
+        # Piggyback on a pending (prefetch) request for the same track
+        if not (task := self.link_requests.get(track_id)):
+            task = asyncio.create_task(
+                self._resolve_streamable_link(track_id, priority)
+            )
+            self.link_requests[track_id] = task
+            task.add_done_callback(lambda _: self.link_requests.pop(track_id, None))
+        return await asyncio.shield(task)
+
+    async def _resolve_streamable_link(self, track_id: int, priority: Priority) -> str:
+        track = await self.aget_track_json(track_id, priority=priority)
+        try:
+            r = await self._get_with_backoff(
+                self._find_transcoding(track)["url"], priority=priority
+            )
+        except httpx.HTTPStatusError:
+            if not self.cache:
+                raise
+            # Transcoding URLs of cached tracks may have gone stale, retry with fresh
+            # track data
+            track = await self.aget_track_json(
+                track_id, use_cache=False, priority=priority
+            )
+            r = await self._get_with_backoff(
+                self._find_transcoding(track)["url"], priority=priority
+            )
         link = r.json()["url"]
-        self.streamable_links[track_id] = (link, now)
+        self.streamable_links.put(track_id, link)
         return link
 
-    def update_liked_track_ids(self, first: int | None = None) -> None:
-        all_likes = list(self.get_collection("me/track_likes/ids"))
-        shuffle(all_likes)
-        if first:
-            all_likes = [first] + [l for l in all_likes if l != first]
-        self.liked_track_ids = all_likes
+    def get_streamable_link(
+        self, track_id: int, priority: Priority = Priority.INTERACTIVE
+    ) -> str:
+        return self.transport.run(self.aget_streamable_link(track_id, priority))
 
-    def _maybe_get_track(self, track_id: int) -> Track | None:
-        try:
-            t = self.get(f"tracks/{track_id}")
-        except HTTPError:
-            # Soundcloud seems to keep liked track IDs even when tracks do not
-            # exist anymore?
-            return None
-        return Track(
-            id=t["id"],
-            title=t["title"],
-            artist=t["user"]["username"],
-            duration_secs=t["duration"] / 1000,
+    def forget_streamable_link(self, track_id: int) -> None:
+        """Drop a cached streamable link that turned out not to work anymore."""
+        self.transport.loop.call_soon_threadsafe(
+            self.streamable_links.discard, track_id
         )
 
+    async def _aprefetch_streamable_links(self, track_ids: list[int]) -> None:
+        await asyncio.gather(
+            *(self.aget_streamable_link(i, Priority.PREFETCH) for i in track_ids),
+            # Whoever actually needs a link will run into any errors soon enough
+            return_exceptions=True,
+        )
+
+    def prefetch_streamable_links(self, track_ids: list[int]) -> None:
+        """Resolve streamable links for upcoming tracks in the background."""
+        self.transport.submit(self._aprefetch_streamable_links(track_ids))
+
+    async def aget_track_json(
+        self,
+        track_id: int,
+        use_cache: bool = True,
+        priority: Priority = Priority.INTERACTIVE,
+    ) -> dict:
+        if (
+            use_cache
+            and self.cache
+            and (cached := await asyncio.to_thread(self.cache.get, track_id))
+        ):
+            return cached
+        track = await self.aget(f"tracks/{track_id}", priority=priority)
+        if self.cache:
+            await asyncio.to_thread(self.cache.put_many, [track])
+        return track
+
+    async def aupdate_liked_track_ids(self, full: bool = False) -> None:
+        """Sync the liked track IDs. Likes are listed newest first, so unless a `full`
+        resync is requested (which also picks up unlikes) only the pages up to the
+        newest like already known are fetched."""
+        likes = self.liked_track_ids
+        newest = None if full else likes.newest
+        new_likes: list[int] = []
+        pages = self._aget_pages("me/track_likes/ids", priority=Priority.BULK)
+        async with aclosing(pages):
+            async for page in pages:
+                if newest in page:
+                    likes.add_newer(new_likes + page[: page.index(newest)])
+                    break
+                new_likes += page
+            else:
+                # Everything was fetched anyway (the newest known like may have been
+                # removed in the meantime), so take it as the complete list
+                likes.replace(new_likes)
+                self.likes_synced_at = time.time()
+        if self.cache:
+            await asyncio.to_thread(
+                self.cache.put_likes,
+                await self.auser_id(),
+                likes.ids,
+                self.likes_synced_at,
+            )
+
+    async def _aload_liked_track_ids(self, full: bool = False) -> None:
+        """Initial sync of the likes, incremental on top of the ones stored in the
+        cache unless a `full` sync was requested or they haven't been synced fully for
+        a while."""
+        if self.cache and (
+            stored := await asyncio.to_thread(
+                self.cache.get_likes, await self.auser_id()
+            )
+        ):
+            ids, self.likes_synced_at = stored
+            self.liked_track_ids.replace(ids)
+        full = full or time.time() - self.likes_synced_at > LIKES_FULL_SYNC_S
+        await self.aupdate_liked_track_ids(full=full)
+
+    async def _get_track_batch(self, track_ids: list[int]) -> list[Track]:
+        """Resolve a batch of track IDs, served from the cache where possible with at
+        most one API call for the rest. Tracks are returned in the order of
+        `track_ids`."""
+        found: dict[int, dict] = {}
+        missing: set[int] = set()
+        if self.cache:
+            found, missing = await asyncio.to_thread(self.cache.get_many, track_ids)
+        if to_fetch := [i for i in track_ids if i not in found and i not in missing]:
+            r = await self._get_with_backoff(
+                self.base_url + "tracks",
+                params=dict(ids=",".join(map(str, to_fetch))),
+                priority=Priority.BULK,
+            )
+            # Soundcloud seems to keep liked track IDs even when tracks do not exist
+            # anymore, these are simply left out of the response
+            fetched = r.json()
+            found |= {t["id"]: t for t in fetched}
+            if self.cache:
+                await asyncio.to_thread(
+                    self.cache.put_many, fetched, missing=set(to_fetch) - found.keys()
+                )
+        return [Track.from_json(found[i]) for i in track_ids if i in found]
+
+    def get_tracks(self, track_ids: list[int]) -> Generator[Track]:
+        """Resolve track metadata for many IDs, yielding tracks in the order of
+        `track_ids` and skipping IDs of deleted tracks.
+
+        IDs are resolved in batches of up to TRACK_BATCH_SIZE with a sliding window of
+        batches in flight. The window grows whenever the consumer has to wait for the
+        next batch and shrinks whenever that batch was already done, so prefetching
+        roughly keeps pace with how fast tracks are actually consumed."""
+        batches = deque(
+            track_ids[i : i + TRACK_BATCH_SIZE]
+            for i in range(0, len(track_ids), TRACK_BATCH_SIZE)
+        )
+        window = MIN_PREFETCH_WINDOW
+        in_flight: deque[Future[list[Track]]] = deque()
+        try:
+            while batches or in_flight:
+                while batches and len(in_flight) < window:
+                    in_flight.append(
+                        self.transport.submit(self._get_track_batch(batches.popleft()))
+                    )
+                head = in_flight.popleft()
+                if head.done():
+                    window = max(MIN_PREFETCH_WINDOW, window - 1)
+                else:
+                    window = min(MAX_PREFETCH_WINDOW, window + 1)
+                yield from head.result()
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+    def get_liked_track_ids(self) -> LikedIndex:
+        """Liked track IDs, waiting for the initial sync if necessary."""
+        self.likes_future.result()
+        return self.liked_track_ids
+
     def get_liked_tracks(self) -> Generator[Track]:
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            futures = [
-                executor.submit(self._maybe_get_track, track_id)
-                for track_id in self.liked_track_ids
-            ]
-            for future in as_completed(futures):
-                if (out := future.result()) is not None:
-                    yield out
+        yield from self.get_tracks(list(self.get_liked_track_ids()))
 
     def get_feed(self, min_track_length_sec: int) -> Generator[Track]:
         seen = set()
-        for i in self.get_collection(
+        pages = self._aget_pages(
             "stream", activityTypes="TrackPost,TrackRepost,PlaylistPost"
-        ):
-            if (
-                "track" not in i
-                or i["track"]["duration"] < min_track_length_sec * 1000
-                or i["track"]["id"] in seen
-            ):
-                continue
-            track = Track(
-                id=i["track"]["id"],
-                title=i["track"]["title"],
-                artist=i["track"]["user"]["username"],
-                duration_secs=i["track"]["duration"] / 1000,
-            )
-            seen.add(track.id)
-            yield track
+        )
+        for page in self.transport.iterate(pages):
+            tracks: dict[int, dict] = {}
+            for i in page:
+                if (
+                    "track" in i
+                    and i["track"]["duration"] >= min_track_length_sec * 1000
+                    and i["track"]["id"] not in seen
+                ):
+                    tracks.setdefault(i["track"]["id"], i["track"])
+            if self.cache:
+                # One transaction per page rather than per track
+                self.cache.put_many(tracks.values())
+            for t in tracks.values():
+                track = Track.from_json(t)
+                seen.add(track.id)
+                yield track
@@ -0,0 +1,140 @@
+import ctypes
+import time
+from threading import Event, Thread
+
+import numpy as np
+import vlc
+
+SAMPLE_RATE = 11025  # VLC resamples the tapped audio to this, i.e. decimates it
+N_FFT = 1024
+RING_SIZE = 8 * N_FFT
+FLOOR_DB = -60.0  # magnitudes at or below this are shown as empty bars
+DECAY = 0.85  # per-frame falloff of the bars
+
+
+class RingBuffer:
+    """Bounded single-producer single-consumer buffer of mono 16-bit samples. The
+    producer only publishes a new `head` after writing the samples and the consumer
+    never writes, so no lock is needed. A reader may occasionally see a few samples
+    being overwritten, which is fine for visualisation purposes."""
+
+    def __init__(self, size: int = RING_SIZE) -> None:
+        self.data = np.zeros(size, dtype=np.int16)
+        self.head = 0  # total number of samples written so far
+
+    def write(self, samples: np.ndarray) -> None:
+        size = len(self.data)
+        samples = samples[-size:]
+        start = self.head % size
+        end = start + len(samples)
+        if end <= size:
+            self.data[start:end] = samples
+        else:
+            split = size - start
+            self.data[start:] = samples[:split]
+            self.data[: end - size] = samples[split:]
+        self.head += len(samples)
+
+    def latest(self, n: int) -> np.ndarray:
+        start = (self.head - n) % len(self.data)
+        return self.data.take(range(start, start + n), mode="wrap")
+
+
+class SpectrumAnalyser:
+    """Turns the most recent samples of a ring buffer into `n_bands` log-spaced band
+    magnitudes in [0,1], at display rate on a worker thread. Does nothing while no
+    new audio arrives."""
+
+    def __init__(self, n_bands: int, fps: float = 20) -> None:
+        self.ring = RingBuffer()
+        self.fps = fps
+        self.window = np.hanning(N_FFT)
+        self.scale = self.window.sum() / 2  # full-scale sine wave -> magnitude 1
+        # Log-spaced band edges in FFT bins, with at least one bin per band
+        n_bins = N_FFT // 2 + 1
+        edges = np.geomspace(1, n_bins, n_bands + 1).astype(int)
+        self.edges = np.minimum(np.maximum(edges, np.arange(n_bands + 1) + 1), n_bins)
+        self.bands = np.zeros(n_bands)  # replaced wholesale, so safe to read any time
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, name="spectrum", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def _run(self) -> None:
+        last_head = self.ring.head
+        while not self._stopped.wait(1 / self.fps):
+            if self.ring.head == last_head:
+                if self.bands.any():
+                    self.bands = self.bands * DECAY
+                    self.bands[self.bands < 0.01] = 0.0
+                continue
+            last_head = self.ring.head
+            self.bands = np.maximum(self._analyse(), self.bands * DECAY)
+
+    def _analyse(self) -> np.ndarray:
+        samples = self.ring.latest(N_FFT) / 32768
+        spectrum = np.abs(np.fft.rfft(samples * self.window)) / self.scale
+        sums = np.add.reduceat(spectrum, self.edges[:-1])
+        magnitudes = sums / np.diff(self.edges)
+        db = 20 * np.log10(magnitudes + 1e-9)
+        return np.clip((db - FLOOR_DB) / -FLOOR_DB, 0.0, 1.0)
+
+
+class AudioTap:
+    """An extra VLC player that plays along with the audible one, but has its decoded
+    audio delivered to a ring buffer (downmixed and resampled by VLC) instead of an
+    audio device. This keeps the analysis entirely out of the audible player's audio
+    path, at the cost of opening the media a second time. Like `PlaybackEngine` it
+    has a standby player, so the next track can be buffered along with the audible
+    one and the spectrum follows it right from the switch."""
+
+    def __init__(self, instance: vlc.Instance, ring: RingBuffer) -> None:
+        self.instance = instance
+        self.ring = ring
+        self._play_cbs: list = []  # keep references to the callbacks, ctypes doesn't
+        self.player = self._new_player()
+        self.standby = self._new_player()
+
+    def _new_player(self) -> vlc.MediaPlayer:
+        player = self.instance.media_player_new()
+
+        def on_play(data, samples, count: int, pts) -> None:
+            # The ring buffer takes a single producer
+            if player is self.player:
+                self.ring.write(
+                    np.frombuffer(ctypes.string_at(samples, count * 2), dtype=np.int16)
+                )
+
+        play_cb = vlc.CallbackDecorators.AudioPlayCb(on_play)
+        self._play_cbs.append(play_cb)
+        player.audio_set_callbacks(play_cb, None, None, None, None, None)
+        player.audio_set_format("S16N", SAMPLE_RATE, 1)
+        return player
+
+    def load(self, mrl: str, start_ms: int = 0) -> None:
+        media = self.instance.media_new(mrl)
+        media.add_option(f"start-time={int(start_ms / 1000)}")
+        self.player.set_media(media)
+
+    def preload(self, mrl: str) -> None:
+        media = self.instance.media_new(mrl)
+        media.add_option("start-paused")
+        self.standby.set_media(media)
+        self.standby.play()
+
+    def swap(self) -> None:
+        self.player, self.standby = self.standby, self.player
+        self.player.set_pause(0)
+        self.standby.stop()
+
+    def play(self) -> None:
+        self.player.play()
+
+    def pause(self) -> None:
+        self.player.set_pause(1)
+
+    def stop(self) -> None:
+        self.player.stop()
+        self.standby.stop()
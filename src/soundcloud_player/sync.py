@@ -0,0 +1,42 @@
+import argparse
+import os
+
+from soundcloud_player.config_manager import ConfigManager
+from soundcloud_player.download import download_likes
+from soundcloud_player.library import META_DIR
+from soundcloud_player.soundcloud_client import SoundCloudClient
+
+QUARANTINE_DIR = META_DIR / "quarantine"  # unliked tracks, relative to the library
+# Refuse to quarantine more than this share of the downloaded tracks at once, that
+# many unlikes at once more likely means the like listing came back short
+MAX_QUARANTINE_SHARE = 0.5
+
+
+def sync_library(
+    sc_client: SoundCloudClient, args: argparse.Namespace, cfg_manager: ConfigManager
+):
+    """Bring the local library in line with the likes: download new ones and, if
+    asked to, move tracks that aren't liked anymore out of the library. The client
+    lists all likes on startup in that case (see `main`), so unlikes are known.
+    Only files scplay downloaded itself are ever moved."""
+    index = download_likes(sc_client, args, cfg_manager)
+    if not args.quarantine:
+        return
+    likes = sc_client.get_liked_track_ids()
+    downloaded = index.downloaded_paths()
+    unliked = [p for track_id, p in downloaded.items() if track_id not in likes]
+    if not unliked:
+        return
+    if not likes or len(unliked) > MAX_QUARANTINE_SHARE * len(downloaded):
+        print(
+            f"Not quarantining {len(unliked)} of {len(downloaded)} downloaded tracks,"
+            f" only {len(likes)} liked tracks were listed"
+        )
+        return
+    quarantine = index.root / QUARANTINE_DIR
+    quarantine.mkdir(parents=True, exist_ok=True)
+    for path in unliked:
+        os.replace(path, quarantine / path.name)
+    index.refresh()
+    index.save()
+    print(f"Moved {len(unliked)} unliked tracks to '{quarantine}'")
@@ -0,0 +1,135 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Iterable
+
+DEFAULT_TTL_S = 7 * 24 * 3600
+DEFAULT_MISSING_TTL_S = 24 * 3600
+DEFAULT_MAX_ENTRIES = 20000
+
+
+class TrackCache:
+    """SQLite-backed store for raw track JSON as returned by the SoundCloud API.
+
+    Entries expire after `ttl_s` and are revalidated by the client on the next
+    request, the least recently used entries are evicted once the cache grows beyond
+    `max_entries`. IDs of tracks that do not exist anymore are kept in a separate
+    negative cache so we don't keep asking for them on every run. The liked track IDs
+    of each user are stored as well, so they can be synced incrementally."""
+
+    def __init__(
+        self,
+        db_path: Path,
+        ttl_s: float = DEFAULT_TTL_S,
+        missing_ttl_s: float = DEFAULT_MISSING_TTL_S,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+    ) -> None:
+        self.ttl_s = ttl_s
+        self.missing_ttl_s = missing_ttl_s
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS tracks (id INTEGER PRIMARY KEY, data TEXT"
+                " NOT NULL, fetched_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS tracks_accessed ON tracks (accessed_at)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS missing (id INTEGER PRIMARY KEY,"
+                " checked_at REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS likes (user_id INTEGER PRIMARY KEY, ids"
+                " TEXT NOT NULL, synced_at REAL NOT NULL)"
+            )
+
+    def get(self, track_id: int) -> dict | None:
+        found, _ = self.get_many([track_id])
+        return found.get(track_id)
+
+    def get_many(self, track_ids: list[int]) -> tuple[dict[int, dict], set[int]]:
+        """Return all fresh cached tracks for the given IDs, as well as the IDs that
+        are known not to exist anymore. All other IDs need to be fetched."""
+        now = time.time()
+        found: dict[int, dict] = {}
+        missing: set[int] = set()
+        with self._lock, self._db:
+            # Stay well below SQLite's limit on the number of query parameters
+            for i in range(0, len(track_ids), 500):
+                chunk = track_ids[i : i + 500]
+                marks = ",".join("?" * len(chunk))
+                for track_id, data in self._db.execute(
+                    f"SELECT id, data FROM tracks WHERE id IN ({marks}) AND"
+                    " fetched_at > ?",
+                    (*chunk, now - self.ttl_s),
+                ):
+                    found[track_id] = json.loads(data)
+                missing.update(
+                    track_id
+                    for track_id, in self._db.execute(
+                        f"SELECT id FROM missing WHERE id IN ({marks}) AND"
+                        " checked_at > ?",
+                        (*chunk, now - self.missing_ttl_s),
+                    )
+                )
+            self._db.executemany(
+                "UPDATE tracks SET accessed_at = ? WHERE id = ?",
+                [(now, track_id) for track_id in found],
+            )
+        return found, missing
+
+    def put_many(self, tracks: Iterable[dict], missing: Iterable[int] = ()) -> None:
+        """Store tracks, and optionally the IDs of tracks found not to exist anymore,
+        in a single transaction."""
+        now = time.time()
+        rows = [(t["id"], json.dumps(t), now, now) for t in tracks]
+        missing_rows = [(track_id, now) for track_id in missing]
+        if not rows and not missing_rows:
+            return
+        with self._lock, self._db:
+            if rows:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?)", rows
+                )
+                self._db.executemany(
+                    "DELETE FROM missing WHERE id = ?", [(row[0],) for row in rows]
+                )
+                self._evict()
+            if missing_rows:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO missing VALUES (?, ?)", missing_rows
+                )
+                self._db.executemany(
+                    "DELETE FROM tracks WHERE id = ?", [(r[0],) for r in missing_rows]
+                )
+
+    def get_likes(self, user_id: int) -> tuple[list[int], float] | None:
+        """Liked track IDs of a user along with the time of their last full sync."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT ids, synced_at FROM likes WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def put_likes(self, user_id: int, ids: list[int], synced_at: float) -> None:
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO likes VALUES (?, ?, ?)",
+                (user_id, json.dumps(ids), synced_at),
+            )
+
+    def _evict(self) -> None:
+        (count,) = self._db.execute("SELECT COUNT(*) FROM tracks").fetchone()
+        if count <= self.max_entries:
+            return
+        self._db.execute(
+            "DELETE FROM tracks WHERE id IN (SELECT id FROM tracks ORDER BY"
+            " accessed_at LIMIT ?)",
+            (count - self.max_entries,),
+        )
@@ -0,0 +1,228 @@
+import asyncio
+import heapq
+import itertools
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from enum import IntEnum
+from random import uniform
+from threading import Thread
+from typing import Any, AsyncIterator, Coroutine, Generator, TypeVar
+
+import httpx
+
+TIMEOUT_S = 3
+MAX_CONNECTIONS = 16
+REQUESTS_PER_S = 10  # sustained request rate towards the API
+BURST = 20  # number of requests that may be sent at once after a quiet period
+
+T = TypeVar("T")
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0  # the user is waiting for it
+    PREFETCH = 1  # the user will likely be waiting for it soon
+    BULK = 2  # metadata and downloads in the background
+
+
+@dataclass
+class SchedulerStats:
+    requests: int = 0
+    throttled: int = 0  # requests rejected by the server as too many
+    retried: int = 0
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Parse a Retry-After header, which is either a number of seconds or a date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestScheduler:
+    """Client-wide token bucket that every request has to pass through. Waiting
+    requests are released strictly by priority (and in order of arrival within a
+    priority), so interactive requests overtake any queued bulk work. When the server
+    signals it's overloaded, the whole bucket is paused rather than every request
+    backing off on its own. Must only be used from the transport's event loop."""
+
+    def __init__(self, rate: float = REQUESTS_PER_S, burst: int = BURST) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.stats = SchedulerStats()
+        self._waiters: list[tuple[int, int, asyncio.Future[None]]] = []
+        self._seq = itertools.count()
+        self._dispatcher: asyncio.Task | None = None
+
+    async def acquire(self, priority: Priority) -> None:
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), waiter))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await waiter
+        self.stats.requests += 1
+
+    def throttle(self, delay_s: float) -> None:
+        """Hold back all requests for (at least) `delay_s` seconds."""
+        self.stats.throttled += 1
+        self.tokens = 0.0
+        # Jitter the end of the pause so we don't come back at a fixed interval
+        until = time.monotonic() + delay_s * uniform(1.0, 1.25)
+        self.paused_until = max(self.paused_until, until)
+
+    async def _dispatch(self) -> None:
+        while self._waiters:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            _, _, waiter = heapq.heappop(self._waiters)
+            if waiter.done():
+                continue  # cancelled while waiting
+            self.tokens -= 1
+            waiter.set_result(None)
+
+
+class BandwidthLimiter:
+    """Token bucket over bytes received, shared by everyone downloading through the
+    transport. Consumers account for what they received and sleep off any debt, so
+    the long-term rate stays at `rate` bytes per second. Must only be used from the
+    transport's event loop."""
+
+    def __init__(self, rate: float, burst: float | None = None) -> None:
+        self.rate = rate
+        self.burst = burst or rate  # one second's worth by default
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    async def consume(self, n_bytes: int) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= n_bytes
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class AsyncTransport:
+    """Owns an asyncio event loop running on a background thread and a single
+    keep-alive connection pool that all HTTP requests share. The number of requests
+    in flight at any time is bounded by `max_connections`, anything beyond that waits
+    for a free slot instead of a free thread.
+
+    Coroutines can be handed to the loop from any other thread via `submit`/`run`,
+    which is what the synchronous facades on top of this build on. Never call them
+    from the loop itself, that would deadlock.
+
+    All API requests are paced by a shared `RequestScheduler`, media downloads can be
+    capped by a shared `BandwidthLimiter`."""
+
+    def __init__(
+        self, headers: dict[str, str], max_connections: int = MAX_CONNECTIONS
+    ) -> None:
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(
+            target=self.loop.run_forever, name="sc-transport", daemon=True
+        )
+        self.thread.start()
+        self.client = httpx.AsyncClient(
+            headers=headers,
+            timeout=TIMEOUT_S,
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+        )
+        self.slots = asyncio.Semaphore(max_connections)
+        self.scheduler = RequestScheduler()
+        self.bandwidth: BandwidthLimiter | None = None  # caps media downloads if set
+
+    def limit_bandwidth(self, bytes_per_s: float | None) -> None:
+        self.bandwidth = BandwidthLimiter(bytes_per_s) if bytes_per_s else None
+
+    def submit(self, coro: Coroutine[Any, Any, T]) -> Future[T]:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Coroutine[Any, Any, T]) -> T:
+        return self.submit(coro).result()
+
+    def iterate(self, agen: AsyncIterator[T]) -> Generator[T]:
+        """Synchronously iterate over an async iterator running on the loop."""
+        while True:
+            try:
+                yield self.run(anext(agen))  # type: ignore[arg-type]
+            except StopAsyncIteration:
+                return
+
+    async def get(
+        self,
+        url: str,
+        priority: Priority = Priority.INTERACTIVE,
+        paced: bool = True,
+        **kwargs,
+    ) -> httpx.Response:
+        """GET `url` once a connection slot is free. Requests that don't go to the API
+        (e.g. media segments served by the CDN) may skip the scheduler with `paced`."""
+        if paced:
+            await self.scheduler.acquire(priority)
+        async with self.slots:
+            return await self.client.get(url, **kwargs)
+
+    async def get_content(
+        self,
+        url: str,
+        priority: Priority = Priority.INTERACTIVE,
+        paced: bool = True,
+        **kwargs,
+    ) -> tuple[httpx.Response, bytes]:
+        """Like `get`, but streams the body in chunks which each have to pass the
+        `BandwidthLimiter` (if any) before more is read, so the cap holds for the
+        actual transfer rate rather than just the average over whole responses."""
+        if paced:
+            await self.scheduler.acquire(priority)
+        chunks = []
+        async with self.slots, self.client.stream("GET", url, **kwargs) as r:
+            async for chunk in r.aiter_bytes():
+                if self.bandwidth:
+                    await self.bandwidth.consume(len(chunk))
+                chunks.append(chunk)
+        return r, b"".join(chunks)
+
+    async def backoff(
+        self, r: httpx.Response | None, attempt: int, paced: bool = True
+    ) -> None:
+        """Wait before retrying the request that led to the failed response `r` (None
+        if it failed without one), honouring any Retry-After hint the server gave us.
+        Only overloaded API servers hold back the scheduler, unpaced requests (e.g. to
+        the CDN) just wait for themselves."""
+        self.scheduler.stats.retried += 1
+        retry_after = r.headers.get("Retry-After") if r is not None else None
+        delay_s = parse_retry_after(retry_after) or 0.5 * (2**attempt)
+        if paced and r is not None and r.status_code in (429, 503):
+            # Everyone needs to slow down, the retry will wait for the scheduler
+            self.scheduler.throttle(delay_s)
+        else:
+            await asyncio.sleep(delay_s * uniform(1.0, 1.5))
+
+    def close(self) -> None:
+        self.run(self.client.aclose())
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -1,4 +1,8 @@
-from random import random, uniform
+from functools import cache
+
+import numpy as np
+
+RNG = np.random.default_rng()
 
 # Braille base char, with no dots visible
 BRAILLE_BASE = 0x2800
@@ -16,6 +20,40 @@ DOTS = [
 ]
 
 
+def quantise(values: np.ndarray, n_rows: int, inverse: bool) -> np.ndarray:
+    """Map values in [0,1] to the number of Braille dots that are turned on in a
+    column of `n_rows` characters, counted from the bottom (or the top if inverse).
+    Dot k (bottom up) sits at height (k + 0.5) / (4 * n_rows) and is turned on if the
+    value is above that height (or below it if inverse)."""
+    n_dots = 4 * n_rows
+    x = np.asarray(values, dtype=float) * n_dots - 0.5
+    if inverse:
+        return n_dots - np.clip(np.floor(x) + 1, 0, n_dots).astype(int)
+    return np.clip(np.ceil(x), 0, n_dots).astype(int)
+
+
+@cache
+def glyph_table(n_rows: int, inverse: bool) -> np.ndarray:
+    """Lookup table of Braille characters (top to bottom) indexed by the quantised
+    left and right value of a column, see `quantise`."""
+    n_dots = 4 * n_rows
+    table = np.empty((n_dots + 1, n_dots + 1, n_rows), dtype="<U1")
+    for left in range(n_dots + 1):
+        for right in range(n_dots + 1):
+            for row in range(n_rows):
+                total_offset = 0
+                # Iterate through Braille dots, bottom up
+                for subrow, offsets in enumerate(DOTS[::-1]):
+                    dot = row * 4 + subrow
+                    for level, offset in zip([left, right], offsets):
+                        lit = dot >= n_dots - level if inverse else dot < level
+                        if lit:
+                            total_offset |= 1 << offset
+                # Rows are stored top to bottom for easier postprocessing
+                table[left, right, n_rows - 1 - row] = chr(BRAILLE_BASE + total_offset)
+    return table
+
+
 def get_braille_col(
     left_val: float, right_val: float, n_rows: int, inverse: bool
 ) -> list[str]:
@@ -23,44 +61,23 @@ def get_braille_col(
     that - stacked from top to bottom - show a representation of the two values. In the
     simplest version where n_rows=1, a left value of 1 and a right value of 0.25 would
     return ⣇. The same values with n_rows=2 would return ⡇ followed by ⣧."""
-    chars = []
-    # Iterate through column, bottom up
-    for row in range(n_rows):
-        total_offset = 0
-        # Iterate through Braille dots, bottom up
-        for subrow, offsets in enumerate(DOTS[::-1]):
-            height = row * 1 / n_rows + subrow * 1 / n_rows / 4 + 1 / n_rows / 8
-            for val, offset in zip([left_val, right_val], offsets):
-                if (val > height) and not inverse:
-                    total_offset |= 1 << offset
-                elif (val < height) and inverse:
-                    total_offset |= 1 << offset
-        chars.append(chr(BRAILLE_BASE + total_offset))
-    return chars[::-1]  # return top-to-bottom view for easier postprocessing
+    left, right = quantise(np.array([left_val, right_val]), n_rows, inverse)
+    return glyph_table(n_rows, inverse)[left, right].tolist()
 
 
 def print_braille_multiline(values, n_rows: int = 1, inverse: bool = False) -> str:
-    chars = [
-        get_braille_col(values[i], values[i + 1], n_rows=n_rows, inverse=inverse)
-        for i in range(0, len(values), 2)
-    ]
-    return "\n".join("".join(col[i] for col in chars) for i in range(n_rows))
+    levels = quantise(values, n_rows=n_rows, inverse=inverse)
+    glyphs = glyph_table(n_rows, inverse)[levels[0::2], levels[1::2]]
+    return "\n".join("".join(glyphs[:, row]) for row in range(n_rows))
 
 
-def update_viz(old_viz: list[float]) -> list[float]:
-    new_viz = []
-    for i, val in enumerate(old_viz):
-        # Trigger some random peaks
-        if random() < 0.03:
-            val = 1
-        # Let bars be influenced by neighboring values
-        if i > 0:
-            val += 0.2 * (old_viz[i - 1] - old_viz[i])
-        if i < len(old_viz) - 1:
-            val += 0.2 * (old_viz[i + 1] - old_viz[i])
-        # Apply some decay and clip
-        val = max(0.0, min(1.0, val * 0.9))
-        if val < 0.1:
-            val = 0
-        new_viz.append(val)
+def update_viz(old_viz: np.ndarray) -> np.ndarray:
+    # Trigger some random peaks
+    new_viz = np.where(RNG.random(len(old_viz)) < 0.03, 1.0, old_viz)
+    # Let bars be influenced by neighboring values
+    new_viz[1:] += 0.2 * (old_viz[:-1] - old_viz[1:])
+    new_viz[:-1] += 0.2 * (old_viz[1:] - old_viz[:-1])
+    # Apply some decay and clip
+    new_viz = np.clip(new_viz * 0.9, 0.0, 1.0)
+    new_viz[new_viz < 0.1] = 0.0
     return new_viz
@@ -0,0 +1,54 @@
+from rich.text import Text
+
+from soundcloud_player.background import Background
+
+
+class Stripes(Background):
+    """Background whose rows are set by the test."""
+
+    def __init__(self, rows: list[str]) -> None:
+        super().__init__()
+        self.rows = rows
+
+    def resize(self, w: int, h: int) -> None:
+        pass
+
+    def get_bg_rows(self, w: int, h: int) -> list[str]:
+        return list(self.rows)
+
+
+def test_unchanged_frame_is_reused():
+    bg = Stripes(["....", "....", "...."])
+    content = [Text("ab")]
+    first = bg.render(content, 4, 3)
+    assert first.plain == "....\n.ab.\n...."
+    assert bg.render(content, 4, 3) is first
+
+
+def test_only_changed_rows_are_composed(monkeypatch):
+    bg = Stripes(["....", "....", "...."])
+    content = [Text("ab")]
+    bg.render(content, 4, 3)
+
+    composed = []
+    compose_row = Background._compose_row
+    monkeypatch.setattr(
+        Background,
+        "_compose_row",
+        staticmethod(lambda *args: composed.append(args) or compose_row(*args)),
+    )
+    bg.rows = ["....", "....", "..*."]
+    assert bg.render(content, 4, 3).plain == "....\n.ab.\n..*."
+    assert len(composed) == 1
+
+    composed.clear()
+    content = [Text("cd")]
+    assert bg.render(content, 4, 3, advance=False).plain == "....\n.cd.\n..*."
+    assert len(composed) == 1
+
+
+def test_resize_recomposes_everything():
+    bg = Stripes(["...", "..."])
+    bg.render([Text("a")], 3, 2)
+    bg.rows = ["....."] * 3
+    assert bg.render([Text("a")], 5, 3).plain == ".....\n..a..\n....."
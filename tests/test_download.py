@@ -0,0 +1,59 @@
+import argparse
+from typing import Any
+
+import httpx
+import pytest
+from rich.progress import Progress
+
+from soundcloud_player import hls
+from soundcloud_player.download import PARTIAL_DIR, download_track
+from soundcloud_player.soundcloud_client import Track
+from soundcloud_player.transport import AsyncTransport
+
+PLAYLIST_URL = "https://cdn.test/track/playlist.m3u8"
+N_SEGMENTS = 10
+FAIL_AT = 6
+
+
+def segment(i: int) -> bytes:
+    """A few MPEG-1 layer III frames (128 kbit/s, 44.1 kHz) tagged with `i`."""
+    return (b"\xff\xfb\x90\x00" + bytes([i]) * 413) * 3
+
+
+def test_interrupted_download_resumes_with_the_remaining_segments(
+    tmp_path, monkeypatch
+):
+    monkeypatch.setattr(hls, "MAX_SEGMENT_RETRIES", 0)
+    fetched: list[int] = []
+    interrupted = True
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url == PLAYLIST_URL:
+            playlist = "".join(f"#EXTINF:10,\n{i}.mp3\n" for i in range(N_SEGMENTS))
+            return httpx.Response(200, text="#EXTM3U\n" + playlist)
+        i = int(request.url.path.rsplit("/", 1)[1].removesuffix(".mp3"))
+        fetched.append(i)
+        if interrupted and i == FAIL_AT:
+            return httpx.Response(503)
+        return httpx.Response(200, content=segment(i))
+
+    transport = AsyncTransport(headers={})
+    transport.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    client: Any = argparse.Namespace(
+        transport=transport, get_streamable_link=lambda track_id, priority: PLAYLIST_URL
+    )
+    track = Track(1, "Title", "Artist", 100)
+    try:
+        with Progress(disable=True) as progress:
+            with pytest.raises(httpx.HTTPStatusError):
+                download_track(track, client, tmp_path, progress)
+            assert not list(tmp_path.glob("*.mp3"))
+            interrupted = False
+            fetched.clear()
+            path = download_track(track, client, tmp_path, progress)
+    finally:
+        transport.close()
+
+    assert sorted(fetched) == list(range(FAIL_AT, N_SEGMENTS))
+    assert path.read_bytes() == b"".join(segment(i) for i in range(N_SEGMENTS))
+    assert not list((tmp_path / PARTIAL_DIR).iterdir())
@@ -0,0 +1,36 @@
+import time
+
+import httpx
+
+from soundcloud_player.hls import aiter_segments
+from soundcloud_player.transport import AsyncTransport
+
+
+def make_transport(handler) -> AsyncTransport:
+    transport = AsyncTransport(headers={})
+    transport.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return transport
+
+
+def test_throttled_segment_waits_for_retry_after_and_succeeds():
+    attempts: list[float] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            return httpx.Response(429, headers={"Retry-After": "0.3"})
+        return httpx.Response(200, content=b"segment")
+
+    transport = make_transport(handler)
+    try:
+        segments = transport.iterate(
+            aiter_segments(transport, ["https://cdn.test/0.mp3"])
+        )
+        assert list(segments) == [b"segment"]
+    finally:
+        transport.close()
+    assert len(attempts) == 2
+    assert attempts[1] - attempts[0] >= 0.3
+    # The CDN throttling us says nothing about the API
+    assert transport.scheduler.stats.throttled == 0
+    assert transport.scheduler.paused_until == 0.0
@@ -0,0 +1,69 @@
+import os
+
+from soundcloud_player import library
+from soundcloud_player.library import LibraryIndex
+
+
+def make_tree(root, rel_paths):
+    for rel_path in rel_paths:
+        (root / rel_path).parent.mkdir(parents=True, exist_ok=True)
+        (root / rel_path).touch()
+    backdate(root)
+
+
+def backdate(root):
+    """Backdate all directories, so any later change to them is seen regardless of how
+    coarse the file system's timestamps are."""
+    for rel_dir, _, _ in os.walk(root):
+        os.utime(rel_dir, (1e9, 1e9))
+
+
+def record_scandir(monkeypatch) -> list[str]:
+    listed: list[str] = []
+    scandir = os.scandir
+
+    def recording_scandir(path):
+        listed.append(os.path.basename(path))
+        return scandir(path)
+
+    monkeypatch.setattr(library.os, "scandir", recording_scandir)
+    return listed
+
+
+def test_refresh_does_not_list_unchanged_directories(tmp_path, monkeypatch):
+    make_tree(tmp_path, ["a_1.mp3", "Artist/Album/b_2.mp3", "Other/c_3.mp3"])
+    index = LibraryIndex(tmp_path)
+    index.refresh()
+    index.save()
+    backdate(tmp_path)  # saving created the metadata directory
+    listed = record_scandir(monkeypatch)
+
+    index = LibraryIndex(tmp_path)
+    index.refresh()
+
+    assert listed == []
+    assert index.track_paths() == {
+        1: tmp_path / "a_1.mp3",
+        2: tmp_path / "Artist" / "Album" / "b_2.mp3",
+        3: tmp_path / "Other" / "c_3.mp3",
+    }
+
+
+def test_refresh_picks_up_changes_in_nested_directories(tmp_path, monkeypatch):
+    make_tree(tmp_path, ["a_1.mp3", "Artist/Album/b_2.mp3", "Other/c_3.mp3"])
+    index = LibraryIndex(tmp_path)
+    index.refresh()
+    listed = record_scandir(monkeypatch)
+
+    (tmp_path / "Artist" / "Album" / "d_4.mp3").touch()
+    index.refresh()
+    assert listed == ["Album"]
+    assert set(index.track_paths()) == {1, 2, 3, 4}
+
+    backdate(tmp_path)
+    index.refresh()
+    listed.clear()
+    (tmp_path / "Artist" / "Album" / "b_2.mp3").unlink()
+    index.refresh()
+    assert listed == ["Album"]
+    assert set(index.track_paths()) == {1, 3, 4}
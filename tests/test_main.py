@@ -0,0 +1,15 @@
+import pytest
+
+from soundcloud_player.main import create_parser
+
+
+@pytest.mark.parametrize("jobs", ["0", "-1", "two"])
+def test_download_rejects_invalid_jobs(jobs):
+    with pytest.raises(SystemExit):
+        create_parser().parse_args(["download", "--jobs", jobs])
+
+
+def test_download_options():
+    args = create_parser().parse_args(["sync", "-j", "3", "--max-rate", "2M"])
+    assert args.jobs == 3
+    assert args.max_rate == 2_000_000
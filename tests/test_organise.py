@@ -0,0 +1,21 @@
+from pathlib import Path
+
+from soundcloud_player.organise import TrackGroup, find_best_matches
+
+
+def test_rounded_tie_goes_to_first_phrase_in_config():
+    # 'call super' scores 91.7 and 'boiler room' 92.3, both are a 92
+    configs = [
+        TrackGroup(album="Call Super", phrases=["call super"]),
+        TrackGroup(album="Boiler Room", phrases=["boiler room"]),
+    ]
+    [match] = find_best_matches([Path("call_supxr_boiler_rodm_83.mp3")], configs)
+    assert match.album == "Call Super"
+    assert match.similarity == 92
+
+
+def test_unmatched_track_is_unsorted():
+    configs = [TrackGroup(album="Call Super", phrases=["call super"])]
+    [match] = find_best_matches([Path("something_else_1.mp3")], configs)
+    assert match.album == "Unsorted"
+    assert match.phrase is None
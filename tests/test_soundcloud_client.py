@@ -0,0 +1,76 @@
+import asyncio
+from concurrent.futures import Future
+
+from soundcloud_player.soundcloud_client import LikedIndex, SoundCloudClient
+from soundcloud_player.track_cache import TrackCache
+from soundcloud_player.transport import AsyncTransport
+
+
+def make_client(cache: TrackCache, pages: list[list[int]]):
+    client = SoundCloudClient.__new__(SoundCloudClient)
+    client.cache = cache
+    client.liked_track_ids = LikedIndex()
+    client.likes_synced_at = 0.0
+    client.user_id_future = Future()
+    client.user_id_future.set_result({"id": 1})
+    fetched: list[list[int]] = []
+
+    async def aget_pages(path, priority=None, **params):
+        for page in pages:
+            fetched.append(page)
+            yield page
+
+    client._aget_pages = aget_pages  # type: ignore[method-assign]
+    return client, fetched
+
+
+def test_initial_like_sync_is_incremental_unless_full(tmp_path):
+    cache = TrackCache(tmp_path / "tracks.sqlite")
+    client, fetched = make_client(cache, [[3, 2], [1]])
+    asyncio.run(client._aload_liked_track_ids())
+    assert client.liked_track_ids.ids == [3, 2, 1]
+    assert len(fetched) == 2
+
+    # A new like on top of the stored ones only needs the first page
+    client, fetched = make_client(cache, [[4, 3], [2, 1]])
+    asyncio.run(client._aload_liked_track_ids())
+    assert client.liked_track_ids.ids == [4, 3, 2, 1]
+    assert len(fetched) == 1
+
+    # A full sync lists everything exactly once and drops unlikes
+    client, fetched = make_client(cache, [[4, 3], [1]])
+    asyncio.run(client._aload_liked_track_ids(full=True))
+    assert client.liked_track_ids.ids == [4, 3, 1]
+    assert 2 not in client.liked_track_ids
+    assert len(fetched) == 2
+
+
+def test_feed_caches_one_page_at_a_time(tmp_path):
+    cache = TrackCache(tmp_path / "tracks.sqlite")
+    writes: list[list[int]] = []
+    put_many = cache.put_many
+    cache.put_many = lambda tracks, **kw: (  # type: ignore[method-assign]
+        writes.append([t["id"] for t in tracks]) or put_many(tracks, **kw)
+    )
+    long, short = 60_000, 1_000
+
+    def item(track_id: int, duration: int) -> dict:
+        return {
+            "track": {
+                "id": track_id,
+                "title": "t",
+                "user": {"username": "u"},
+                "duration": duration,
+            }
+        }
+
+    client, _ = make_client(
+        cache, [[item(1, long), item(2, short), item(1, long)], [item(3, long)]]
+    )
+    client.transport = AsyncTransport(headers={})
+    try:
+        feed = [t.id for t in client.get_feed(min_track_length_sec=30)]
+    finally:
+        client.transport.close()
+    assert feed == [1, 3]
+    assert writes == [[1], [3]]
@@ -0,0 +1,79 @@
+import argparse
+
+from soundcloud_player.library import LibraryIndex
+from soundcloud_player.soundcloud_client import LikedIndex
+from soundcloud_player.sync import QUARANTINE_DIR, sync_library
+
+
+class FakeClient:
+    def __init__(self, liked_ids: list[int]) -> None:
+        self.likes = LikedIndex()
+        self.likes.replace(liked_ids)
+        self.transport = argparse.Namespace(limit_bandwidth=lambda rate: None)
+        self.requested: list[list[int]] = []
+
+    def get_liked_track_ids(self) -> LikedIndex:
+        return self.likes
+
+    def get_tracks(self, track_ids):
+        self.requested.append(track_ids)
+        return iter([])
+
+
+class FakeConfig:
+    def __init__(self, lib_path) -> None:
+        self.lib_path = lib_path
+
+    def get_local_lib(self):
+        return self.lib_path
+
+
+def make_library(root, downloaded, other=()):
+    """Create empty mp3s, recording the `downloaded` ones as written by scplay."""
+    for rel_path in [*downloaded, *other]:
+        (root / rel_path).parent.mkdir(parents=True, exist_ok=True)
+        (root / rel_path).touch()
+    index = LibraryIndex(root)
+    index.refresh()
+    for rel_path in downloaded:
+        index.update(root / rel_path, downloaded=True)
+    index.save()
+
+
+ARGS = argparse.Namespace(jobs=1, order="newest", max_rate=None, quarantine=True)
+
+
+def test_sync_downloads_new_likes_and_quarantines_unliked(tmp_path):
+    make_library(tmp_path, ["kept_1.mp3", "album/unliked_2.mp3", "kept_4.mp3"])
+    client = FakeClient([3, 1, 4])
+
+    sync_library(client, ARGS, FakeConfig(tmp_path))  # type: ignore[arg-type]
+
+    # Metadata is only requested for likes that aren't in the library yet
+    assert client.requested == [[3]]
+    assert (tmp_path / "kept_1.mp3").exists()
+    assert not (tmp_path / "album" / "unliked_2.mp3").exists()
+    assert (tmp_path / QUARANTINE_DIR / "unliked_2.mp3").exists()
+
+
+def test_sync_leaves_files_it_did_not_download(tmp_path):
+    make_library(
+        tmp_path,
+        ["kept_1.mp3", "kept_3.mp3", "unliked_2.mp3"],
+        other=["Unsorted/foo_2019.mp3"],
+    )
+
+    sync_library(FakeClient([1, 3]), ARGS, FakeConfig(tmp_path))  # type: ignore[arg-type]
+
+    assert (tmp_path / "Unsorted" / "foo_2019.mp3").exists()
+    assert (tmp_path / QUARANTINE_DIR / "unliked_2.mp3").exists()
+
+
+def test_sync_refuses_to_quarantine_most_of_the_library(tmp_path):
+    make_library(tmp_path, ["kept_1.mp3", "gone_2.mp3", "gone_3.mp3"])
+
+    sync_library(FakeClient([1]), ARGS, FakeConfig(tmp_path))  # type: ignore[arg-type]
+    sync_library(FakeClient([]), ARGS, FakeConfig(tmp_path))  # type: ignore[arg-type]
+
+    assert all((tmp_path / f"{name}.mp3").exists() for name in ["gone_2", "gone_3"])
+    assert not (tmp_path / QUARANTINE_DIR).exists()
@@ -0,0 +1,19 @@
+from soundcloud_player.track_cache import TrackCache
+
+
+def track(track_id: int) -> dict:
+    return {"id": track_id, "title": "t", "user": {"username": "u"}, "duration": 1}
+
+
+def test_tracks_and_missing_ids_are_stored_together(tmp_path):
+    cache = TrackCache(tmp_path / "tracks.sqlite")
+    cache.put_many([track(1), track(2)], missing=[3])
+    found, missing = cache.get_many([1, 2, 3, 4])
+    assert found.keys() == {1, 2}
+    assert missing == {3}
+
+    # A track showing up again is no longer missing and vice versa
+    cache.put_many([track(3)], missing=[1])
+    found, missing = cache.get_many([1, 2, 3])
+    assert found.keys() == {2, 3}
+    assert missing == {1}
@@ -0,0 +1,34 @@
+import time
+
+import httpx
+
+from soundcloud_player.transport import AsyncTransport, BandwidthLimiter
+
+CHUNK = b"x" * 100_000
+
+
+def test_bandwidth_limit_applies_while_reading_a_response():
+    pulled: list[float] = []
+
+    async def body():
+        for _ in range(5):
+            pulled.append(time.monotonic())
+            yield CHUNK
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=body())
+
+    transport = AsyncTransport(headers={})
+    transport.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    transport.bandwidth = BandwidthLimiter(rate=500_000, burst=100_000)
+    try:
+        r, content = transport.run(
+            transport.get_content("https://cdn.test/0.mp3", paced=False)
+        )
+    finally:
+        transport.close()
+    assert r.status_code == 200
+    assert content == CHUNK * 5
+    # Every chunk beyond the burst has to wait for the previous one to be paid for
+    # before it's even read
+    assert pulled[-1] - pulled[0] >= 0.55